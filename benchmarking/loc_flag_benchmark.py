@@ -0,0 +1,49 @@
+import argparse
+import numpy as np
+import os
+import pandas as pd
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from light_utils import get_loc_flag, loc_flags
+
+def get_args():
+  parser = argparse.ArgumentParser(description="time get_loc_flag against loc_flags on a simulated paired class input")
+  parser.add_argument("-n", "--rows", type=int, default=2000000, help="number of reads in the simulated table")
+  parser.add_argument("-j", "--junctions", type=int, default=100000, help="number of distinct junctions the reads are spread over")
+  parser.add_argument("-s", "--seed", type=int, default=0)
+  return parser.parse_args()
+
+def simulate(n, junctions, seed):
+  """The columns get_loc_flag reads, with every junction type, unstranded reads and reads without a mate junction"""
+  rng = np.random.default_rng(seed)
+  junc_types = rng.choice(["lin","rev","sc","fus","err"], size=junctions, p=[0.6,0.2,0.08,0.08,0.04])
+  posA = rng.integers(1, 10 ** 8, size=junctions)
+  posB = posA + rng.integers(-10 ** 5, 10 ** 5, size=junctions)
+  refNames = ("chr1:GENE:" + pd.Series(posA).astype(str) + ":+|chr1:GENE:" + pd.Series(posB).astype(str) + ":+|" + junc_types).to_numpy()
+  junction = rng.integers(0, junctions, size=n)
+  posR2A = (posA[junction] + rng.integers(-10 ** 5, 10 ** 5, size=n)).astype(np.float64)
+  posR2A[rng.random(n) < 0.2] = np.nan
+  return pd.DataFrame({"refName_ABR1" : refNames[junction], "juncPosR1A" : posA[junction], "juncPosR1B" : posB[junction], "juncPosR2A" : posR2A,
+                       "read_strandR1A" : rng.choice(["+","-",np.nan], size=n, p=[0.49,0.49,0.02])})
+
+def main():
+  args = get_args()
+  df = simulate(args.rows, args.junctions, args.seed)
+
+  t0 = time.time()
+  old = df.apply(get_loc_flag, axis=1)
+  t_apply = time.time() - t0
+
+  t0 = time.time()
+  new = loc_flags(df)
+  t_vectorized = time.time() - t0
+
+  assert new.equals(pd.array(old.where(old != "error", pd.NA).tolist(), dtype="Int64"))
+  print("{} rows, {} junctions".format(args.rows, args.junctions))
+  print("apply(get_loc_flag): {:.2f}s".format(t_apply))
+  print("loc_flags: {:.2f}s".format(t_vectorized))
+  print("speed-up: {:.0f}x".format(t_apply / t_vectorized))
+
+main()
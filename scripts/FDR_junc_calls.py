@@ -34,6 +34,9 @@ def get_names(data_paths, col, use_cols):
     print(len(dp_dict[data_path]["names"]),"names")
   return dp_dict
 
+# junction positions GLM_output.txt carries next to refName_newR1, read when present instead of parsing them out of it
+junc_pos_cols = ["juncPosR1A","juncPosR1B"]
+
 def get_score_df(results, data_path, col, use_cols, score_df, hard_filt_df, unlim_read, frac_genomic, sd_overlap, avg_AT, avg_ent, intron_len, avg_GC, prefix=""):
   t0 = time.time()
   for i in range(len(results["names"])):
@@ -44,7 +47,7 @@ def get_score_df(results, data_path, col, use_cols, score_df, hard_filt_df, unli
     if name.startswith(prefix):
 
 #      print("before read",data_path,name)
-      temp_df = pd.read_csv("{}{}/GLM_output.txt".format(data_path,name),usecols=use_cols,sep="\t")
+      temp_df = pd.read_csv("{}{}/GLM_output.txt".format(data_path,name),usecols=lambda c : c in use_cols or c in junc_pos_cols,sep="\t")
       temp_hard_df = temp_df
       temp_hard_df["hard_inc"] = 0
       temp_hard_df = temp_hard_df[["refName_newR1","hard_inc"]]
@@ -65,7 +68,10 @@ def get_score_df(results, data_path, col, use_cols, score_df, hard_filt_df, unli
         temp_df = temp_df[temp_df["ave_entropyR1"] > 3]
   
       if intron_len:
-        temp_df["intron_length"] = abs(temp_df["refName_newR1"].str.split(":").str[2].astype(int) - temp_df["refName_newR1"].str.split(":").str[5].astype(int))
+        if all(c in temp_df.columns for c in junc_pos_cols):
+          temp_df["intron_length"] = abs(temp_df["juncPosR1A"] - temp_df["juncPosR1B"])
+        else:
+          temp_df["intron_length"] = abs(temp_df["refName_newR1"].str.split(":").str[2].astype(int) - temp_df["refName_newR1"].str.split(":").str[5].astype(int))
         temp_df = temp_df[temp_df["intron_length"] > 30]
       temp_hard_df.loc[temp_df.index,"hard_inc"] = 1
       score_df = pd.concat([score_df, temp_df[use_cols[:2]]], axis=0)
@@ -1,4 +1,17 @@
+from abc import ABC, abstractmethod
+import bisect
+from collections import OrderedDict
+import fcntl
+import functools
+import graphlib
+import hashlib
+import json
+import numpy as np
+import os
 import pandas as pd
+import pickle
+import shutil
+import tempfile
 
 def get_gene_id(row):
 #  return row["attribute"].split(";")[0].split()[1][1:-1]
@@ -7,98 +20,748 @@ def get_gene_id(row):
   elif ";gene=" in row["attribute"]:
     return row["attribute"].split(";gene=")[-1].split(";")[0]
 
-def round_down(num, divisor): 
+def get_gene_ids(attributes):
+  """Vectorized get_gene_id over a column of gtf attributes"""
+  has_name = attributes.str.contains("gene_name", regex=False)
+  names = attributes.str.rsplit("gene_name", n=1).str[-1].str.split('"', n=2).str[1]
+  genes = attributes.str.rsplit(";gene=", n=1).str[-1].str.split(";", n=1).str[0]
+  has_gene = attributes.str.contains(";gene=", regex=False)
+  return names.where(has_name, genes.where(has_gene, None))
+
+def round_down(num, divisor):
     return num - (num%divisor)
 
 # This is a class to create an annotator object that you can create based on a gtf file,
 # that allows you to put in a chromosome and position and get all gene names in that area.
 
 # Usage example:
-# import sys 
-# sys.path.insert(0, '/scratch/PI/horence/JuliaO/single_cell/scripts/') 
+# import sys
+# sys.path.insert(0, '/scratch/PI/horence/JuliaO/single_cell/scripts/')
 # import annotator
-# 
-# ann = annotator.Annotator(/scratch/PI/horence/JuliaO/single_cell/STAR_output/mm10_files/mm10.gtf) # this step can take a while - like 2 minutes
+#
+# ann = annotator.Annotator(/scratch/PI/horence/JuliaO/single_cell/STAR_output/mm10_files/mm10.gtf) # reads the gtf in a single pass; mostly pd.read_csv time
 # ann.get_name_given_locus("chr1", 1003024) # returns all gene names separated by ","; if none, returns ""
 
+# The default "interval" backend cuts every chromosome into segments at gene starts and ends + 1.
+# The set of overlapping genes is constant inside a segment, so the answer for every segment is
+# worked out once when the annotator is built and a lookup is a binary search over the segment
+# bounds. The "dict" backend is the original jump-bucketed dict of dicts and is kept as a reference.
+
+segment_dtypes = {"bounds" : np.int64, "labels" : np.int32, "strands" : np.int8, "occupied" : bool}
+
+class GeneSegments:
+  """Sorted segment bounds of one chromosome with the label and strand code of every segment"""
+  def __init__(self, bounds, labels, strands, occupied):
+    # segment i covers [bounds[i - 1], bounds[i]); segment 0 is everything before bounds[0]
+    self.bounds = np.asarray(bounds, dtype=segment_dtypes["bounds"])
+    self.labels = np.asarray(labels, dtype=segment_dtypes["labels"])
+    self.strands = np.asarray(strands, dtype=segment_dtypes["strands"])
+
+    # occupied[b] is True if any gene touches bucket b (of size jump); positions in empty
+    # buckets are "unknown" while positions in occupied buckets that miss every gene are ""
+    self.occupied = np.asarray(occupied, dtype=segment_dtypes["occupied"])
+
+    # python list copy of bounds for bisect, made on the first scalar lookup so that
+    # memory-mapped chromosomes that are never queried are never read
+    self.bound_list = None
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["bound_list"] = None
+    return state
+
+  def lookup(self, position, jump):
+    bucket = position // jump
+    if position < 0 or bucket >= len(self.occupied) or not self.occupied[bucket]:
+      return None
+    if self.bound_list is None:
+      self.bound_list = self.bounds.tolist()
+    seg = bisect.bisect_right(self.bound_list, position)
+    return self.labels[seg], self.strands[seg]
+
+def get_occupied(starts, ends, jump):
+  if len(starts) == 0:
+    return np.zeros(0, dtype=bool)
+  first = np.asarray(starts) // jump
+  last = np.asarray(ends) // jump
+  diff = np.zeros(last.max() + 2, dtype=np.int64)
+  np.add.at(diff, first, 1)
+  np.add.at(diff, last + 1, -1)
+  return np.cumsum(diff)[:-1] > 0
+
+def chrom_segments(chrom_args):
+  """Segments of one chromosome, with labels and strands coded into tables local to the chromosome"""
+  starts, ends, names, gene_strands, jump, unknown_strand = chrom_args
+  opening = {}
+  closing = {}
+  for g in range(len(names)):
+    opening.setdefault(starts[g], []).append(g)
+    closing.setdefault(ends[g] + 1, []).append(g)
+  bounds = np.unique(np.concatenate([starts, ends + 1]))
+  labels = [""]
+  strands = [unknown_strand]
+  label_codes = {"" : 0}
+  strand_codes = {unknown_strand : 0}
+  label_ind = [0]
+  strand_ind = [0]
+  active = set()
+  for pos in bounds.tolist():
+    active.update(opening.get(pos, []))
+    active.difference_update(closing.get(pos, []))
+    hits = sorted(active)
+    label = ",".join([names[g] for g in hits])
+    seg_strands = set([gene_strands[g] for g in hits])
+    if len(seg_strands) == 1:
+      strand = seg_strands.pop()
+    else:
+      strand = unknown_strand
+    if label not in label_codes:
+      label_codes[label] = len(labels)
+      labels.append(label)
+    if strand not in strand_codes:
+      strand_codes[strand] = len(strands)
+      strands.append(strand)
+    label_ind.append(label_codes[label])
+    strand_ind.append(strand_codes[strand])
+  return bounds, labels, np.array(label_ind), strands, np.array(strand_ind), get_occupied(starts, ends, jump)
+
+def columnar_path(annotator_path):
+  """Directory holding the columnar version of a pickled annotator path"""
+  return os.path.splitext(annotator_path)[0] + ".annotator/"
+
+def has_annotator(annotator_path):
+  """Whether there's a columnar or pickled annotator at annotator_path"""
+  return os.path.isdir(columnar_path(annotator_path)) or os.path.exists(annotator_path)
+
+def load_annotator(annotator_path, mmap_mode = "r", lazy = False, max_chroms = None):
+  """Load the columnar annotator next to annotator_path if there is one, then the pickle, else None"""
+  if os.path.isdir(columnar_path(annotator_path)):
+    return Annotator.load(columnar_path(annotator_path), mmap_mode=mmap_mode, lazy=lazy, max_chroms=max_chroms)
+  if os.path.exists(annotator_path):
+    return pickle.load(open(annotator_path, "rb"))
+  return None
+
+def require_annotator(annotator_path, mmap_mode = "r", lazy = False, max_chroms = None):
+  """load_annotator, raising an error that names annotator_path when there's no annotator there"""
+  ann = load_annotator(annotator_path, mmap_mode=mmap_mode, lazy=lazy, max_chroms=max_chroms)
+  if ann is None:
+    raise FileNotFoundError("no annotator at {} or {} (build one with create_annotator.py)".format(annotator_path, columnar_path(annotator_path)))
+  return ann
+
+def gtf_hash(gtf_path, chunk_size = 2 ** 20):
+  """sha256 of the contents of a gtf file"""
+  h = hashlib.sha256()
+  with open(gtf_path, "rb") as f:
+    for chunk in iter(lambda: f.read(chunk_size), b""):
+      h.update(chunk)
+  return h.hexdigest()
+
+def known_gtf_hash(gtf_path, cache_dir, check = False):
+  """gtf_hash, remembered in cache_dir by the gtf's real path, size and mtime
+
+  An unchanged gtf is only read once; touching or replacing it makes the next job hash it
+  again. With check the contents are hashed anyway and the remembered hash is refreshed.
+  """
+  st = os.stat(gtf_path)
+  stat_key = "{}\0{}\0{}".format(os.path.realpath(gtf_path), st.st_size, st.st_mtime_ns)
+  hash_path = os.path.join(cache_dir, "gtf_{}.sha256".format(hashlib.sha256(stat_key.encode()).hexdigest()[:32]))
+  if not check and os.path.exists(hash_path):
+    with open(hash_path) as f:
+      return f.read().strip()
+  digest = gtf_hash(gtf_path)
+  fd, tmp_path = tempfile.mkstemp(prefix="gtf_", suffix=".tmp", dir=cache_dir)
+  with os.fdopen(fd, "w") as f:
+    f.write(digest + "\n")
+  os.chmod(tmp_path, 0o644)
+  os.replace(tmp_path, hash_path)
+  return digest
+
+# bump whenever the columnar layout Annotator.save writes changes, so older cache entries aren't reused
+columnar_version = 1
+
+def cache_key(gtf_hash, jump = 10000):
+  """Name of the cached annotator built from gtf content with this hash, jump and columnar_version"""
+  return "{}_jump{}_v{}".format(gtf_hash, jump, columnar_version)
+
+def cached_annotator(gtf_path, cache_dir, jump = 10000, mmap_mode = "r", lazy = False, max_chroms = None, check_gtf = False):
+  """Columnar annotator for gtf_path from cache_dir, building it first if no job has yet
+
+  Entries are keyed by the gtf content and jump, so an edited gtf gets a new entry instead of
+  a stale index; the content hash is only recomputed when the gtf's stat changes, or every
+  time with check_gtf. The first job to miss builds the entry under a lock while the others
+  wait for it, and an entry only appears under its final name once it is completely written.
+  """
+  os.makedirs(cache_dir, exist_ok=True)
+  key = cache_key(known_gtf_hash(gtf_path, cache_dir, check=check_gtf), jump)
+  path = os.path.join(cache_dir, key)
+  if not os.path.isdir(path):
+    with open(path + ".lock", "a") as lock:
+      fcntl.lockf(lock, fcntl.LOCK_EX)
+      try:
+        # another job may have built it while we waited for the lock
+        if not os.path.isdir(path):
+          tmp_path = tempfile.mkdtemp(prefix=key + ".tmp", dir=cache_dir)
+          try:
+            Annotator(gtf_path, jump=jump).save(tmp_path)
+            # mkdtemp is private to its owner, but the cache is shared
+            os.chmod(tmp_path, 0o755)
+            os.rename(tmp_path, path)
+          except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+      finally:
+        fcntl.lockf(lock, fcntl.LOCK_UN)
+  return Annotator.load(path, mmap_mode=mmap_mode, lazy=lazy, max_chroms=max_chroms)
+
+class ChromCache(ABC):
+  """Read-only dict of per-chromosome indexes that loads a chromosome on first access
+
+  If max_resident is set only that many of the most recently used chromosomes are kept
+  in memory; the others are dropped and loaded again when they are next asked for.
+  Subclasses say how a chromosome is loaded with load_chrom.
+  """
+  def __init__(self, seqnames, max_resident = None):
+    self.seqnames = list(seqnames)
+    self.known = set(self.seqnames)
+    self.max_resident = max_resident
+    self.resident = OrderedDict()
+
+  @abstractmethod
+  def load_chrom(self, seqname):
+    """The index of one chromosome, read from disk"""
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state["resident"] = OrderedDict()
+    return state
+
+  def __getitem__(self, seqname):
+    if seqname in self.resident:
+      self.resident.move_to_end(seqname)
+      return self.resident[seqname]
+    if seqname not in self.known:
+      raise KeyError(seqname)
+    value = self.load_chrom(seqname)
+    self.resident[seqname] = value
+    if self.max_resident and len(self.resident) > self.max_resident:
+      self.resident.popitem(last=False)
+    return value
+
+  def __contains__(self, seqname):
+    return seqname in self.known
+
+  def __iter__(self):
+    return iter(self.seqnames)
+
+  def __len__(self):
+    return len(self.seqnames)
+
+  def keys(self):
+    return list(self.seqnames)
+
+  def get(self, seqname, default = None):
+    if seqname in self.known:
+      return self[seqname]
+    return default
+
+class LazySegments(ChromCache):
+  """GeneSegments of an annotator directory written by Annotator.save, sliced out per chromosome"""
+  def __init__(self, path, mmap_mode = "r", max_resident = None):
+    self.path = path
+    self.mmap_mode = mmap_mode
+    self.open_columns()
+    ChromCache.__init__(self, load_strings(os.path.join(path, "seqnames")), max_resident)
+    self.chrom_index = {seqname : i for i, seqname in enumerate(self.seqnames)}
+
+  def open_columns(self):
+    self.columns = {}
+    for name in segment_dtypes:
+      self.columns[name] = (np.load(os.path.join(self.path, name + ".npy"), mmap_mode="r"), np.load(os.path.join(self.path, name + "_chrom_offsets.npy")))
+
+  def __getstate__(self):
+    state = ChromCache.__getstate__(self)
+    del state["columns"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.open_columns()
+
+  def load_chrom(self, seqname):
+    i = self.chrom_index[seqname]
+    arrays = [data[offsets[i]:offsets[i + 1]] for data, offsets in self.columns.values()]
+
+    # without mmap_mode only this chromosome's rows are read into memory
+    if self.mmap_mode is None:
+      arrays = [np.array(a) for a in arrays]
+    return GeneSegments(*arrays)
+
+def chrom_groups(chroms):
+  """(seqname, indices) for every distinct chromosome in an array, sorting the array only once"""
+  chrom_codes, uniq_chroms = pd.factorize(np.asarray(chroms, dtype=object))
+  order = np.argsort(chrom_codes, kind="stable")
+
+  # missing chromosomes have code -1 and come first
+  splits = np.cumsum(np.bincount(chrom_codes + 1, minlength=len(uniq_chroms) + 1))
+  for k, seqname in enumerate(uniq_chroms):
+    yield seqname, order[splits[k]:splits[k + 1]]
+
+def pack_pairs(low, high):
+  """64-bit keys for position pairs: low in the upper 32 bits, high in the lower 32"""
+  return (np.asarray(low, dtype=np.int64) << 32) | np.asarray(high, dtype=np.int64)
+
+class ChromKeys:
+  """Sorted keys of one chromosome that answer `in` like the set they replace"""
+  def __init__(self, keys, pairs):
+    self.keys = keys
+    self.pairs = pairs
+
+  def __contains__(self, value):
+    if self.pairs:
+      value = int(pack_pairs(value[0], value[1]))
+    i = np.searchsorted(self.keys, value)
+    return i < len(self.keys) and self.keys[i] == value
+
+  def __len__(self):
+    return len(self.keys)
+
+class LazyKeys(ChromCache):
+  """Per-chromosome keys of a directory written by SortedKeys.save, sliced out on first use"""
+  def __init__(self, path, mmap_mode = "r", max_resident = None):
+    self.path = path
+    self.mmap_mode = mmap_mode
+    self.open_columns()
+    ChromCache.__init__(self, load_strings(os.path.join(path, "seqnames")), max_resident)
+    self.chrom_index = {seqname : i for i, seqname in enumerate(self.seqnames)}
+
+  def open_columns(self):
+    self.data = np.load(os.path.join(self.path, "keys.npy"), mmap_mode="r")
+    self.offsets = np.load(os.path.join(self.path, "keys_chrom_offsets.npy"))
+
+  def __getstate__(self):
+    state = ChromCache.__getstate__(self)
+    del state["data"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.open_columns()
+
+  def load_chrom(self, seqname):
+    i = self.chrom_index[seqname]
+    keys = self.data[self.offsets[i]:self.offsets[i + 1]]
+    if self.mmap_mode is None:
+      keys = np.array(keys)
+    return keys
+
+class SortedKeys:
+  """Compact replacement for the exon_bounds / splices dicts of sets
+
+  Every chromosome holds one sorted int64 array: exon boundary positions, or splice
+  junctions packed into one key per (low, high) pair. contains() tests a whole batch
+  of loci at once with np.searchsorted.
+  """
+  def __init__(self, keys, pairs = False):
+    self.keys = keys
+    self.pairs = pairs
+
+  @classmethod
+  def from_sets(cls, chrom_dict, pairs = False):
+    keys = {}
+    for seqname, values in chrom_dict.items():
+      if pairs:
+        values = sorted(values)
+        keys[seqname] = np.unique(pack_pairs([v[0] for v in values], [v[1] for v in values]))
+      else:
+        keys[seqname] = np.unique(np.fromiter(values, dtype=np.int64, count=len(values)))
+    return cls(keys, pairs)
+
+  @classmethod
+  def load(cls, path, mmap_mode = "r", lazy = False, max_chroms = None):
+    with open(os.path.join(path, "meta.json")) as f:
+      meta = json.load(f)
+    keys = LazyKeys(path, mmap_mode=mmap_mode, max_resident=max_chroms)
+    if not lazy:
+      keys = {seqname : keys.load_chrom(seqname) for seqname in keys}
+    return cls(keys, meta["pairs"])
+
+  def save(self, path):
+    os.makedirs(path, exist_ok=True)
+    seqnames = list(self.keys.keys())
+    arrays = [self.keys[seqname] for seqname in seqnames]
+    offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(a) for a in arrays])
+    np.save(os.path.join(path, "keys.npy"), np.concatenate([np.zeros(0, dtype=np.int64)] + arrays))
+    np.save(os.path.join(path, "keys_chrom_offsets.npy"), offsets)
+    save_strings(os.path.join(path, "seqnames"), seqnames)
+    with open(os.path.join(path, "meta.json"), "w") as f:
+      json.dump({"pairs" : self.pairs}, f)
+
+  def __contains__(self, seqname):
+    return seqname in self.keys
+
+  def __getitem__(self, seqname):
+    return ChromKeys(self.keys[seqname], self.pairs)
+
+  def contains(self, chroms, values, values2 = None):
+    """Boolean array: is values[i] (or the pair values[i], values2[i]) annotated on chroms[i]"""
+    values = np.asarray(values, dtype=np.int64)
+    if self.pairs:
+      values2 = np.asarray(values2, dtype=np.int64)
+      values = pack_pairs(np.minimum(values, values2), np.maximum(values, values2))
+    found = np.zeros(len(values), dtype=bool)
+    for seqname, ind in chrom_groups(chroms):
+      if seqname not in self.keys:
+        continue
+      keys = self.keys[seqname]
+      i = np.searchsorted(keys, values[ind])
+      hit = i < len(keys)
+      hit[hit] = keys[i[hit]] == values[ind][hit]
+      found[ind] = hit
+    return found
+
+def keys_path(pickle_path):
+  """Directory holding the SortedKeys version of a pickled exon_bounds / splices dict"""
+  return os.path.splitext(pickle_path)[0] + ".keys/"
+
+def load_keys(pickle_path, pairs = False, max_chroms = None):
+  """SortedKeys saved next to pickle_path if there are any, otherwise built from the pickle"""
+  if os.path.isdir(keys_path(pickle_path)):
+    return SortedKeys.load(keys_path(pickle_path), lazy=True, max_chroms=max_chroms)
+  return SortedKeys.from_sets(pickle.load(open(pickle_path, "rb")), pairs)
+
+def annotate_junction_ends(chrA, posA, chrB, posB, exon_bounds, splices):
+  """splice_ann, exon_annA, exon_annB and both_ann arrays for a batch of junctions"""
+  chrA = pd.Series(chrA, dtype=object).reset_index(drop=True)
+  chrB = pd.Series(chrB, dtype=object).reset_index(drop=True)
+  posA = pd.to_numeric(pd.Series(posA).reset_index(drop=True), errors="coerce")
+  posB = pd.to_numeric(pd.Series(posB).reset_index(drop=True), errors="coerce")
+  hasA = (chrA.notna() & posA.notna()).to_numpy()
+  hasB = (chrB.notna() & posB.notna()).to_numpy()
+  exonA = np.zeros(len(chrA), dtype=bool)
+  exonB = np.zeros(len(chrA), dtype=bool)
+  splice = np.zeros(len(chrA), dtype=bool)
+  exonA[hasA] = exon_bounds.contains(chrA[hasA], posA[hasA])
+  exonB[hasB] = exon_bounds.contains(chrB[hasB], posB[hasB])
+  same = hasA & hasB & (chrA == chrB).to_numpy()
+  splice[same] = splices.contains(chrA[same], posA[same], posB[same])
+  return splice, exonA, exonB, exonA & exonB
+
+def save_strings(path, strings):
+  data = [x.encode("utf-8") for x in strings]
+  offsets = np.zeros(len(data) + 1, dtype=np.int64)
+  offsets[1:] = np.cumsum([len(x) for x in data])
+  np.save(path + "_data.npy", np.frombuffer(b"".join(data), dtype=np.uint8))
+  np.save(path + "_offsets.npy", offsets)
+
+def load_strings(path, mmap_mode = "r"):
+  data = np.load(path + "_data.npy", mmap_mode=mmap_mode).tobytes()
+  offsets = np.load(path + "_offsets.npy").tolist()
+  return [data[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(len(offsets) - 1)]
+
+class GeneStrands:
+  """Strand of every gene in a *_gene_strand.txt table, by name or by (name, chromosome)
+
+  Genes are a hash index and strands a code per gene into strand_labels, so looking up a column of
+  genes is one get_indexer and a take. A gene listed twice gets its last strand.
+  """
+  def __init__(self, genes, chroms, strand_codes, strand_labels):
+    self.genes = list(genes)
+    self.chroms = None if chroms is None else list(chroms)
+    self.strand_codes = np.asarray(strand_codes, dtype=np.int8)
+    self.strand_labels = list(strand_labels)
+    if self.chroms is None:
+      self.index = pd.Index(self.genes, dtype=object)
+    else:
+      self.index = pd.MultiIndex.from_arrays([self.genes, self.chroms])
+
+  @classmethod
+  def from_table(cls, gene_strand_info, by_chrom = False):
+    """From the gene_name, strand (and chr, with by_chrom) columns of a gene strand table"""
+    gene_strand_info = gene_strand_info.drop_duplicates(["gene_name","chr"] if by_chrom else "gene_name", keep="last")
+    strand_codes, strand_labels = pd.factorize(gene_strand_info["strand"])
+    return cls(gene_strand_info["gene_name"], gene_strand_info["chr"] if by_chrom else None, strand_codes, strand_labels)
+
+  def lookup(self, genes, chroms = None):
+    """Strands of arrays of genes (on chroms, if keyed by chromosome), NaN for genes not in the table"""
+    if self.chroms is None:
+      rows = self.index.get_indexer(pd.Index(genes, dtype=object))
+    else:
+      rows = self.index.get_indexer(pd.MultiIndex.from_arrays([list(genes), list(chroms)]))
+    codes = np.where(rows >= 0, self.strand_codes[rows], -1) if len(self.genes) > 0 else np.full(len(rows), -1)
+    return np.array(self.strand_labels + [np.nan], dtype=object)[codes]
+
+  def save(self, path):
+    os.makedirs(path, exist_ok=True)
+    save_strings(os.path.join(path, "genes"), self.genes)
+    if self.chroms is not None:
+      save_strings(os.path.join(path, "chroms"), self.chroms)
+    save_strings(os.path.join(path, "strand_labels"), self.strand_labels)
+    np.save(os.path.join(path, "strand_codes.npy"), self.strand_codes)
+
+  @classmethod
+  def load(cls, path):
+    chroms = None
+    if os.path.exists(os.path.join(path, "chroms_data.npy")):
+      chroms = load_strings(os.path.join(path, "chroms"))
+    return cls(load_strings(os.path.join(path, "genes")), chroms, np.load(os.path.join(path, "strand_codes.npy")),
+               load_strings(os.path.join(path, "strand_labels")))
+
 class Annotator:
-  def __init__(self, gtf_file, jump = 10000):
+  # memoized find_locus set up by set_locus_cache; None means every lookup goes to the index
+  locus_cache = None
+  # GeneStrands of the assembly if one was built with the annotator, for renaming junctions
+  gene_strands = None
+
+  def __init__(self, gtf_file, jump = 10000, backend = "interval", pool = None):
     self.jump = jump
     self.gtf_file = gtf_file
     self.unknown = "unknown"
     self.unknown_strand = "?"
-    self.get_gtf_dict()
+    self.backend = backend
+    if backend == "dict":
+      self.get_gtf_dict()
+    elif backend == "interval":
+      self.build_segments(self.get_genes(), pool)
+    else:
+      raise ValueError("unknown annotator backend {}".format(backend))
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state.pop("locus_cache", None)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+
+    # annotators pickled before the interval backend existed only carry gtf_dict
+    if "backend" not in state:
+      self.backend = "interval"
+      self.build_segments(self.genes_from_gtf_dict())
+      del self.gtf_dict
+
+  def get_genes(self):
 
-  def get_gtf_dict(self):
-    print("here")
-  
     # load in gtf
-    gtf_df = pd.read_csv(self.gtf_file,sep="\t",names=["seqname","source","feature","start","end","score","strand","frame","attribute"],comment="#")
-    print(gtf_df.head()) 
+    gtf_df = pd.read_csv(self.gtf_file,sep="\t",names=["seqname","source","feature","start","end","score","strand","frame","attribute"],usecols=["seqname","start","end","strand","attribute"],comment="#")
+    print("read gtf: {} lines".format(gtf_df.shape[0]))
     # make gene id column
-    gtf_df["gene_id"] = gtf_df.apply(get_gene_id, axis=1)
-    print(gtf_df.head())
-    
+    gtf_df["gene_id"] = get_gene_ids(gtf_df["attribute"])
+
     # figure out how long to make each chromosome entry
-    seqname_len_dict = {}
-    for seqname in gtf_df["seqname"].unique():
-        print(seqname)
-        seqname_len_dict[seqname] = max(gtf_df[gtf_df["seqname"] == seqname]["end"])
-        if seqname_len_dict[seqname] < max(gtf_df[gtf_df["seqname"] == seqname]["start"]):
-            print("start more than end")
-  
+    seqname_groups = gtf_df.groupby("seqname", sort=False)
+    self.seqname_len_dict = seqname_groups["end"].max().to_dict()
+    if (seqname_groups["start"].max() > seqname_groups["end"].max()).any():
+      print("start more than end")
+
+    # one row per gene and chromosome, in the order chromosomes and then genes were first seen in the gtf
+    gene_groups = gtf_df.groupby(["seqname","gene_id"], sort=False)
+    genes = gene_groups.agg(start=("start","min"), end=("end","max"), strand=("strand","first")).reset_index()
+    mixed = (gene_groups["strand"].nunique(dropna=False) != 1).to_numpy()
+    genes.loc[mixed,"strand"] = self.unknown_strand
+    seqname_rank = pd.Series(range(len(self.seqname_len_dict)), index=list(self.seqname_len_dict.keys()))
+    genes = genes.iloc[np.argsort(genes["seqname"].map(seqname_rank).to_numpy(), kind="stable")].reset_index(drop=True)
+    print("got {} genes on {} chromosomes".format(genes.shape[0], len(self.seqname_len_dict)))
+    return genes[["seqname","gene_id","start","end","strand"]]
+
+  def get_gtf_dict(self):
+    genes = self.get_genes()
+
     # set up gtf dict to have a dictionary for each chromsome with entries for every "jump" in its length
-    gtf_dict = {s : {r : {} for r in range(0, seqname_len_dict[s],self.jump)} for s in seqname_len_dict.keys()}
-  
-    # assign genes to their requisite ranges
-    for seqname in seqname_len_dict:
-        seqname_df = gtf_df[gtf_df["seqname"] == seqname]
-        for gene_id in seqname_df["gene_id"].unique():
-            if gene_id is not None:
-              gene_df = seqname_df[seqname_df["gene_id"] == gene_id]
-              if len(gene_df["strand"].unique()) == 1:
-  #              print("gene_df['strand'].unique(): {}".format(gene_df['strand'].unique()))
-  #              print("gene_df['strand'].unique()[0]: {}".format(gene_df["strand"].unique()[0]))
-                strand = gene_df["strand"].unique()[0]
-              else:
-                strand = self.unknown_strand
-    
-              # assign gene to all ranges it falls within
-              try:
-                start = min(gene_df["start"])
-              except:
-                print("gene_id",gene_id)
-                print("start failed", gene_df)
-              try: 
-                end = max(gene_df["end"])
-              except:
-                print("gene_id",gene_id)
-                print("end failed",gene_df)
-              for j in range(round_down(start,self.jump),round_down(end + self.jump, self.jump),self.jump):
-                  gtf_dict[seqname][j][gene_id] = [start,end, strand] 
+    gtf_dict = {s : {r : {} for r in range(0, self.seqname_len_dict[s],self.jump)} for s in self.seqname_len_dict.keys()}
+
+    # assign genes to all ranges they fall within
+    for seqname, gene_id, start, end, strand in zip(genes["seqname"], genes["gene_id"], genes["start"], genes["end"], genes["strand"]):
+      for j in range(round_down(start,self.jump),round_down(end + self.jump, self.jump),self.jump):
+          gtf_dict[seqname][j][gene_id] = [start,end, strand]
     self.gtf_dict = gtf_dict
 
-  def get_name_given_locus(self, seqname, position): 
-   
-      try: 
-          poss_genes = self.gtf_dict[seqname][round_down(position,self.jump)] 
-      except Exception as e: 
-          if seqname not in self.gtf_dict.keys(): 
-              return self.unknown, self.unknown_strand 
-          if position > max(self.gtf_dict[seqname].keys()): 
+  def genes_from_gtf_dict(self):
+    genes = {"seqname" : [], "gene_id" : [], "start" : [], "end" : [], "strand" : []}
+    for seqname, buckets in self.gtf_dict.items():
+
+      # every bucket lists its genes in gtf order, so any order consistent with all buckets
+      # gives the same joined names as the bucket lookup did
+      gene_info = {}
+      order = graphlib.TopologicalSorter()
+      for bucket in buckets.values():
+        prev = None
+        for gene_id, pos in bucket.items():
+          gene_info[gene_id] = pos
+          if prev is None:
+            order.add(gene_id)
+          else:
+            order.add(gene_id, prev)
+          prev = gene_id
+      for gene_id in order.static_order():
+        start, end, strand = gene_info[gene_id]
+        genes["seqname"].append(seqname)
+        genes["gene_id"].append(gene_id)
+        genes["start"].append(start)
+        genes["end"].append(end)
+        genes["strand"].append(strand)
+    return pd.DataFrame.from_dict(genes)
+
+  def build_segments(self, genes, pool = None):
+    """Segment index of every chromosome, built in parallel over chromosomes if given a multiprocessing pool"""
+    chrom_args = [(seqname_df["start"].to_numpy(dtype=np.int64), seqname_df["end"].to_numpy(dtype=np.int64),
+                   list(seqname_df["gene_id"]), list(seqname_df["strand"]), self.jump, self.unknown_strand)
+                  for seqname, seqname_df in genes.groupby("seqname", sort=False)]
+    seqnames = list(genes["seqname"].drop_duplicates())
+    if pool is None:
+      chrom_results = map(chrom_segments, chrom_args)
+    else:
+      chrom_results = pool.imap(chrom_segments, chrom_args)
+
+    # merge the per-chromosome string tables in chromosome order, so the codes match a serial build
+    self.labels = [""]
+    self.strand_labels = [self.unknown_strand]
+    label_codes = {"" : 0}
+    strand_codes = {self.unknown_strand : 0}
+    self.segments = {}
+    for seqname, (bounds, labels, label_ind, strands, strand_ind, occupied) in zip(seqnames, chrom_results):
+      for label in labels:
+        if label not in label_codes:
+          label_codes[label] = len(self.labels)
+          self.labels.append(label)
+      for strand in strands:
+        if strand not in strand_codes:
+          strand_codes[strand] = len(self.strand_labels)
+          self.strand_labels.append(strand)
+      label_map = np.array([label_codes[label] for label in labels], dtype=segment_dtypes["labels"])
+      strand_map = np.array([strand_codes[strand] for strand in strands], dtype=segment_dtypes["strands"])
+      self.segments[seqname] = GeneSegments(bounds, label_map[label_ind], strand_map[strand_ind], occupied)
+
+  def save(self, path):
+    """Write the segment index as .npy files plus string tables that load() can memory-map"""
+    if self.backend != "interval":
+      raise ValueError("only the interval backend can be saved in columnar format")
+    os.makedirs(path, exist_ok=True)
+    seqnames = list(self.segments.keys())
+    segments = [self.segments[seqname] for seqname in seqnames]
+
+    # the arrays of all chromosomes are concatenated; chromosome i owns rows offsets[i]:offsets[i + 1]
+    for name in segment_dtypes:
+      arrays = [getattr(seg, name) for seg in segments]
+      offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+      offsets[1:] = np.cumsum([len(a) for a in arrays])
+      np.save(os.path.join(path, name + ".npy"), np.concatenate([np.zeros(0, dtype=segment_dtypes[name])] + arrays))
+      np.save(os.path.join(path, name + "_chrom_offsets.npy"), offsets)
+    save_strings(os.path.join(path, "seqnames"), seqnames)
+    save_strings(os.path.join(path, "labels"), self.labels)
+    save_strings(os.path.join(path, "strand_labels"), self.strand_labels)
+    meta = {"jump" : self.jump, "gtf_file" : self.gtf_file, "unknown" : self.unknown, "unknown_strand" : self.unknown_strand}
+    with open(os.path.join(path, "meta.json"), "w") as f:
+      json.dump(meta, f)
+    if self.gene_strands is not None:
+      self.gene_strands.save(os.path.join(path, "gene_strands"))
+
+  @classmethod
+  def load(cls, path, mmap_mode = "r", lazy = False, max_chroms = None):
+    """Annotator whose segment arrays are memory-mapped from a directory written by save()
+
+    With lazy a chromosome is only set up on its first query, and max_chroms caps how many
+    chromosomes stay resident.
+    """
+    ann = cls.__new__(cls)
+    with open(os.path.join(path, "meta.json")) as f:
+      ann.__dict__.update(json.load(f))
+    ann.backend = "interval"
+    ann.labels = load_strings(os.path.join(path, "labels"))
+    ann.strand_labels = load_strings(os.path.join(path, "strand_labels"))
+    if os.path.isdir(os.path.join(path, "gene_strands")):
+      ann.gene_strands = GeneStrands.load(os.path.join(path, "gene_strands"))
+    segments = LazySegments(path, mmap_mode=mmap_mode, max_resident=max_chroms)
+    if lazy:
+      ann.segments = segments
+    else:
+      ann.segments = {seqname : segments.load_chrom(seqname) for seqname in segments}
+    return ann
+
+  def annotate_codes(self, chroms, positions):
+    """Label and strand codes for arrays of loci; -1 marks the unknown answer"""
+    positions = np.asarray(positions, dtype=np.int64)
+    label_codes = np.full(len(positions), -1, dtype=np.int32)
+    strand_codes = np.full(len(positions), -1, dtype=np.int8)
+
+    for seqname, ind in chrom_groups(chroms):
+      if seqname not in self.segments:
+        continue
+      seg = self.segments[seqname]
+      pos = positions[ind]
+      bucket = pos // self.jump
+      known = (pos >= 0) & (bucket < len(seg.occupied))
+      known[known] = seg.occupied[bucket[known]]
+      ind = ind[known]
+      seg_ind = np.searchsorted(seg.bounds, pos[known], side="right")
+      label_codes[ind] = seg.labels[seg_ind]
+      strand_codes[ind] = seg.strands[seg_ind]
+    return label_codes, strand_codes
+
+  def annotate_many(self, chroms, positions):
+    """Vectorized get_name_given_locus: arrays of gene names and strands for arrays of chromosomes and positions"""
+    if self.backend == "dict":
+      hits = [self.get_name_given_locus(c, int(p)) for c, p in zip(chroms, positions)]
+      return np.array([h[0] for h in hits], dtype=object), np.array([h[1] for h in hits], dtype=object)
+    label_codes, strand_codes = self.annotate_codes(chroms, positions)
+    labels = np.array(self.labels + [self.unknown], dtype=object)
+    strands = np.array(self.strand_labels + [self.unknown_strand], dtype=object)
+    return labels[label_codes], strands[strand_codes]
+
+  def set_locus_cache(self, max_size = 2 ** 18):
+    """Memoize get_name_given_locus on (seqname, position), keeping the max_size most recent loci
+
+    Junctional reads pile up on the same donor/acceptor coordinates, so most lookups become a
+    dict hit. max_size = None turns the cache off again.
+    """
+    if max_size is None:
+      self.locus_cache = None
+    else:
+      self.locus_cache = functools.lru_cache(maxsize=max_size)(self.find_locus)
+
+  def locus_cache_info(self):
+    """hits, misses, maxsize and currsize of the locus cache (None if it is off)"""
+    if self.locus_cache is None:
+      return None
+    return self.locus_cache.cache_info()
+
+  def get_name_given_locus(self, seqname, position):
+    if self.locus_cache is not None:
+      return self.locus_cache(seqname, position)
+    return self.find_locus(seqname, position)
+
+  def find_locus(self, seqname, position):
+    if self.backend == "dict":
+      return self.get_name_given_locus_dict(seqname, position)
+    try:
+      hit = self.segments[seqname].lookup(position, self.jump)
+    except KeyError:
+      return self.unknown, self.unknown_strand
+    if hit is None:
+      return self.unknown, self.unknown_strand
+    return self.labels[hit[0]], self.strand_labels[hit[1]]
+
+  def get_name_given_locus_dict(self, seqname, position):
+
+      try:
+          poss_genes = self.gtf_dict[seqname][round_down(position,self.jump)]
+      except Exception as e:
+          if seqname not in self.gtf_dict.keys():
+              return self.unknown, self.unknown_strand
+          if position > max(self.gtf_dict[seqname].keys()):
               return self.unknown, self.unknown_strand
-          else: 
-              raise e 
-      if len(poss_genes) == 0: 
-          return self.unknown, self.unknown_strand 
-      gene_names = [] 
+          else:
+              raise e
+      if len(poss_genes) == 0:
+          return self.unknown, self.unknown_strand
+      gene_names = []
       strands = []
-      for gene, pos in poss_genes.items(): 
+      for gene, pos in poss_genes.items():
           if pos[0] <= position <= pos[1]:
               gene_names.append(gene)
               strands.append(pos[2])
       if len(set(strands)) == 1:
         strand = strands[0]
       else:
-        strand = self.unknown_strand 
+        strand = self.unknown_strand
       return ",".join(gene_names), strand
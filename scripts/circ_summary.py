@@ -9,6 +9,8 @@ import numpy as np
 import pandas as pd
 import time
 
+from light_utils import class_input_dtypes
+
 def main():
   t0 = time.time()
   parser = argparse.ArgumentParser(description="create summary of circles found")
@@ -31,7 +33,9 @@ def main():
 #  df = pd.read_csv("/scratch/PI/horence/Roozbeh/single_cell_project/output/TS_pilot_10X_withinbam_cSM_10_cJOM_10_aSJMN_0_cSRGM_0/{}/class_input_WithinBAM.tsv".format(outname),
 #                  sep="\t")
 #  single = True
-  df = pd.read_csv(args.input_file, sep="\t")
+  columns = pd.read_csv(args.input_file, sep="\t", nrows=0).columns
+  # class inputs from before location_compatible was NA where it can't be told have "error" there
+  df = pd.read_csv(args.input_file, sep="\t", dtype=class_input_dtypes(columns), na_values={"location_compatible" : ["error"]})
 
 
   # set parameters
@@ -72,7 +76,7 @@ def main():
     #   print(row["refName_ABR1"])
       for h in halves:
         half = half_dict[h]
-        sub_df = df[(df["chrR1" + half] == row["chrR1" + half]) & 
+        sub_df = df[["readClassR1", "refName_ABR1"]][(df["chrR1" + half] == row["chrR1" + half]) & 
                (df["geneR1" + half] == row["geneR1" + half]) & 
                (df["juncPosR1" + half] == row["juncPosR1" + half]) &
                (df[p_col] > args.p_thresh) & (df["location_compatible"] == 1) &
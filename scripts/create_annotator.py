@@ -1,24 +1,30 @@
 import annotator
 import argparse
+from multiprocessing import Pool
+import numpy as np
+import os
 import pandas as pd
 import pickle
 import time
 
 def get_args():
   parser = argparse.ArgumentParser(description="create annotator for assembly")
-  parser.add_argument("-g", "--gtf_path", help="the path to the gtf file to use for annotation", default=False)
-  parser.add_argument("-a", "--assembly", help="The name of the assembly to pre-load annotation (so, mm10 for the 10th mouse assembly)")
+  parser.add_argument("-g", "--gtf_path", nargs="+", help="the paths to the gtf files to use for annotation, one per assembly", default=False)
+  parser.add_argument("-a", "--assembly", nargs="+", help="The names of the assemblies to pre-load annotation (so, mm10 for the 10th mouse assembly)")
+  parser.add_argument("-p", "--from_pickle", help="only convert this pickled annotator to the columnar format, without reading a gtf or rebuilding the exon bounds and splices (only with a single assembly)", default=False)
+  parser.add_argument("-s", "--gene_strand", nargs="+", help="the gene strand table (gene_name, strand and for Mmur_3.0 chr) of each assembly, saved with its annotator for renaming junctions", default=None)
+  parser.add_argument("-n", "--processes", type=int, help="number of processes to build the chromosomes with", default=os.cpu_count())
   args = parser.parse_args()
+  if not args.assembly:
+    parser.error("give the assemblies to build")
+  if not args.from_pickle and (not args.gtf_path or len(args.gtf_path) != len(args.assembly)):
+    parser.error("give one gtf file per assembly")
+  if args.gene_strand and len(args.gene_strand) != len(args.assembly):
+    parser.error("give one gene strand table per assembly")
+  if args.from_pickle and len(args.assembly) != 1:
+    parser.error("--from_pickle converts a single assembly")
   return args
 
-def get_transcript_id(row):
-  if "gene_name" in row["attribute"]:
-    return row["attribute"].split("transcript_id")[-1].split('"')[1]
-
-def get_exon_number(row):
-  if "gene_name" in row["attribute"]:
-    return int(row["attribute"].split("exon_number")[-1].split('"')[1])
-
 #def get_exon_number2(row):
 #  return int(row["attribute"].split("ID=exon")[1].split(";")[0].split("-")[-1])
 #  if "gene_name" in row["attribute"]:
@@ -39,58 +45,111 @@ def get_exon_bounds(gtf_df):
   return exon_bounds
 
 def get_splices(gtf_df):
-  gtf_df["transcript_id"] = gtf_df.apply(get_transcript_id, axis=1)
-#  try:
-  gtf_df["exon_number"] = gtf_df.apply(get_exon_number, axis=1)
-#  except:
-#    gtf_df["exon_number"] = gtf_df.apply(get_exon_number2, axis=1)
+  # exons of named genes (gene_name, or gene= in a gff), with the transcript_id and exon_number of a gtf or
+  # the transcript_id= (else Parent=) and exon_number= (else the ID=exon-...-n) of a gff
+  attributes = gtf_df["attribute"]
+  has_name = annotator.get_gene_ids(attributes).notna()
+  transcript_ids = attributes.str.extract(r'transcript_id "([^"]+)"', expand=False)
+  transcript_ids = transcript_ids.fillna(attributes.str.extract("transcript_id=([^;]+)", expand=False)).fillna(attributes.str.extract("Parent=([^;]+)", expand=False))
+  exon_numbers = attributes.str.extract(r'exon_number "?(\d+)"?', expand=False)
+  exon_numbers = exon_numbers.fillna(attributes.str.extract(r"exon_number=(\d+)", expand=False)).fillna(attributes.str.extract(r"ID=exon-[^;]*-(\d+)(?:;|$)", expand=False))
+  exons = pd.DataFrame({"seqname" : gtf_df["seqname"], "start" : gtf_df["start"], "end" : gtf_df["end"],
+                        "transcript_id" : transcript_ids, "exon_number" : exon_numbers})
+  exons = exons[has_name & (gtf_df["feature"] == "exon")].dropna(subset=["transcript_id","exon_number"])
+  exons["exon_number"] = exons["exon_number"].astype(int)
+
+  # the first exon with each number in a transcript, sorted so exon i + 1 follows exon i
+  exons = exons.drop_duplicates(["seqname","transcript_id","exon_number"])
+  exons = exons.sort_values(["seqname","transcript_id","exon_number"], kind="stable")
+  nxt = exons.shift(-1)
+  consecutive = ((nxt["seqname"] == exons["seqname"]) & (nxt["transcript_id"] == exons["transcript_id"]) & (nxt["exon_number"] == exons["exon_number"] + 1)).to_numpy()
+  ends = exons["end"].to_numpy()[consecutive]
+  starts = nxt["start"].to_numpy()[consecutive].astype(ends.dtype)
+  junctions = pd.DataFrame({"seqname" : exons["seqname"].to_numpy()[consecutive], "low" : np.minimum(ends, starts), "high" : np.maximum(ends, starts)})
 
   splices = {}
-  count = 0
-  t0 = time.time()
-  for name1, group1 in gtf_df[gtf_df["feature"] == "exon"].groupby("seqname"):
-    splices[name1] = set()
-    count += 1
-    print(count, name1, time.time())
-    for name2, group2 in group1.groupby("transcript_id"):
-      for i in range(1,max(group2["exon_number"])):
-        splices[name1].add(tuple(sorted([group2[group2["exon_number"] == i].iloc[0]["end"],group2[group2["exon_number"] == i + 1].iloc[0]["start"]])))
+  for name, group in junctions.groupby("seqname"):
+    splices[name] = set(zip(group["low"].tolist(), group["high"].tolist()))
   return splices
 
-def main():
+def by_chrom(pool, func, gtf_df):
+  """Apply func to the gtf rows of every chromosome in parallel and merge the {chromosome : index} dicts"""
+  chrom_dict = {}
+  for result in pool.imap(func, [group for name, group in gtf_df.groupby("seqname")]):
+    chrom_dict.update(result)
+  return chrom_dict
 
-  save_splices = False
-  save_exon_bounds = True
-  save_ann = True
+class PhaseTimer:
+  """Prints the wall time of every phase of a build"""
+  def __init__(self, assembly):
+    self.assembly = assembly
+    self.start = time.time()
 
-  args = get_args()
-  wrapper_path = "/oak/stanford/groups/horence/Roozbeh/single_cell_project/scripts/STAR_wrapper/"
-  #annotator_path = "{}annotators/pyensembl_{}.pkl".format(wrapper_path, args.assembly)
-  annotator_path = "{}annotators/{}.pkl".format(wrapper_path, args.assembly)
+  def lap(self, phase):
+    now = time.time()
+    print("{} {}: {:.1f}s".format(self.assembly, phase, now - self.start))
+    self.start = now
+
+def build_assembly(pool, wrapper_path, assembly, gtf_path, from_pickle, gene_strand_path = None, save_splices = True, save_exon_bounds = True, save_ann = True):
+  #annotator_path = "{}annotators/pyensembl_{}.pkl".format(wrapper_path, assembly)
+  annotator_path = "{}annotators/{}.pkl".format(wrapper_path, assembly)
   print(annotator_path)
+  timer = PhaseTimer(assembly)
 
-  gtf_df = get_gtf(args.gtf_path)
+  # a pickled annotator already has its gene index, so the gtf is only read for the other tables
+  if save_exon_bounds or save_splices or (save_ann and not from_pickle):
+    gtf_df = get_gtf(gtf_path)
+    timer.lap("read gtf")
   if save_exon_bounds:
-    exon_bounds = get_exon_bounds(gtf_df)
-    pickle.dump(exon_bounds, open("{}annotators/{}_exon_bounds.pkl".format(wrapper_path, args.assembly), "wb"))
-    print("{}annotators/{}_exon_bounds.pkl".format(wrapper_path, args.assembly))
+    exon_bounds = by_chrom(pool, get_exon_bounds, gtf_df)
+    timer.lap("exon bounds")
+    pickle.dump(exon_bounds, open("{}annotators/{}_exon_bounds.pkl".format(wrapper_path, assembly), "wb"))
+    annotator.SortedKeys.from_sets(exon_bounds).save(annotator.keys_path("{}annotators/{}_exon_bounds.pkl".format(wrapper_path, assembly)))
+    print("{}annotators/{}_exon_bounds.pkl".format(wrapper_path, assembly))
+    timer.lap("save exon bounds")
 
   if save_splices:
-    splices = get_splices(gtf_df)
-    pickle.dump(splices, open("{}annotators/{}_splices.pkl".format(wrapper_path, args.assembly), "wb"))
+    splices = by_chrom(pool, get_splices, gtf_df)
+    timer.lap("splices")
+    pickle.dump(splices, open("{}annotators/{}_splices.pkl".format(wrapper_path, assembly), "wb"))
+    annotator.SortedKeys.from_sets(splices, pairs=True).save(annotator.keys_path("{}annotators/{}_splices.pkl".format(wrapper_path, assembly)))
   
-    print("{}annotators/{}_splices.pkl".format(wrapper_path, args.assembly))
+    print("{}annotators/{}_splices.pkl".format(wrapper_path, assembly))
+    timer.lap("save splices")
 #  if os.path.exists(annotator_path):
 #    ann = pickle.load(open(annotator_path, "rb"))
 #  else:
-  #  ann = pyensembl.Genome(reference_name = args.assembly,
+  #  ann = pyensembl.Genome(reference_name = assembly,
   #           annotation_name = "my_genome_features",
-  #           gtf_path_or_url=args.gtf_path)
+  #           gtf_path_or_url=gtf_path)
   #  ann.index()
   
   if save_ann:
-    ann = annotator.Annotator(args.gtf_path)
+    if from_pickle:
+      ann = pickle.load(open(from_pickle, "rb"))
+      annotator_path = from_pickle
+    else:
+      ann = annotator.Annotator(gtf_path, pool=pool)
     print("got annotator")
-    pickle.dump(ann, open(annotator_path, "wb"))
-    print("dumped annotator to {}".format(annotator_path))
-main()
+    timer.lap("gene index")
+    if gene_strand_path:
+      # modify_refnames keys Mmur_3.0 genes by chromosome too
+      ann.gene_strands = annotator.GeneStrands.from_table(pd.read_csv(gene_strand_path, sep="\t"), by_chrom=assembly == "Mmur_3.0")
+      timer.lap("gene strands")
+    ann.save(annotator.columnar_path(annotator_path))
+    print("saved annotator to {}".format(annotator.columnar_path(annotator_path)))
+    timer.lap("save gene index")
+
+def main():
+  args = get_args()
+  wrapper_path = "/oak/stanford/groups/horence/Roozbeh/single_cell_project/scripts/STAR_wrapper/"
+
+  # one pool for all assemblies; every phase is split over chromosomes
+  with Pool(args.processes) as pool:
+    gtf_paths = args.gtf_path or [None] * len(args.assembly)
+    for i, (assembly, gtf_path) in enumerate(zip(args.assembly, gtf_paths)):
+      build_assembly(pool, wrapper_path, assembly, gtf_path, args.from_pickle, args.gene_strand[i] if args.gene_strand else None,
+                     save_splices=not args.from_pickle, save_exon_bounds=not args.from_pickle)
+
+if __name__ == "__main__":
+  main()
@@ -49,22 +49,16 @@ def get_kmer_seq_chim(cigar, seq, fileType, k, kmer_dict):
   kmer_seq = seq[max(readPos - k,0):min(readPos + k,len(seq))]
   return kmer_seq
 
-def exon1(read, exon_bounds):
-  if read["chrR1A"] not in exon_bounds:
-    return False
-  return read["juncPosR1A"] in exon_bounds[read["chrR1A"]]
-
-def exon2(read, exon_bounds):
-  if read["chrR1B"] not in exon_bounds:
-    return False
-  return read["juncPosR1B"] in exon_bounds[read["chrR1B"]]
-
-def splice_ann(read, splices):
-  if read["chrR1A"] != read["chrR1B"]:
-    return False
-  if read["chrR1A"] not in splices:
-    return False
-  return tuple(sorted([read["juncPosR1A"], read["juncPosR1B"]])) in splices[read["chrR1A"]]
+def annotate_refnames(refNames, exon_bounds, splices):
+  """{refName : (splice_ann, exon_annA, exon_annB, both_ann)} computed once per distinct junction"""
+  refNames = pd.Series(pd.unique(pd.Series(list(refNames), dtype=object)), dtype=object)
+  if len(refNames) == 0:
+    return {}
+  ends = refNames.str.split("|", expand=True)
+  endA = ends[0].str.split(":", expand=True)
+  endB = ends[1].str.split(":", expand=True)
+  anns = annotator.annotate_junction_ends(endA[0], endA[2], endB[0], endB[2], exon_bounds, splices)
+  return dict(zip(refNames, zip(*[a.tolist() for a in anns])))
 
 
 def get_read_fragment(posR1A, posR1B, juncPosR1A, juncPosR1B, seqR1):
@@ -440,11 +434,20 @@ def get_SM(cigar):
 
   return M, S, I, D
 
-def write_class_file(junc_read_dict,out_file, single, genomic_alignments, tenX, include_one_read):
+def write_class_file(junc_read_dict,out_file, single, genomic_alignments, tenX, include_one_read, max_chroms = None, assembly = "hg38"):
   k = 14
-  splices = pickle.load(open("/oak/stanford/groups/horence/JuliaO/pickled/grch38_juncs.pkl","rb"))
+
+  # splices regenerated for the assembly by create_annotator.py, if they have been built
+  splices_path = "/oak/stanford/groups/horence/Roozbeh/single_cell_project/scripts/STAR_wrapper/annotators/{}_splices.pkl".format(assembly)
+  if not os.path.exists(splices_path):
+    splices_path = "/oak/stanford/groups/horence/JuliaO/pickled/grch38_juncs.pkl"
+  splices = annotator.load_keys(splices_path, pairs=True, max_chroms=max_chroms)
   kmer_dict = pickle.load(open("/oak/stanford/groups/horence/Roozbeh/single_cell_project/scripts/STAR_wrapper/annotators/kmer_dict_{}.pkl".format(k),"rb"))
-  exon_bounds = pickle.load(open("/oak/stanford/groups/horence/Roozbeh/single_cell_project/scripts/STAR_wrapper/annotators/hg38_exon_bounds_all.pkl","rb"))
+  # likewise the assembly's exon bounds, else the hg38 ones
+  exon_bounds_path = "/oak/stanford/groups/horence/Roozbeh/single_cell_project/scripts/STAR_wrapper/annotators/{}_exon_bounds.pkl".format(assembly)
+  if not os.path.exists(exon_bounds_path):
+    exon_bounds_path = "/oak/stanford/groups/horence/Roozbeh/single_cell_project/scripts/STAR_wrapper/annotators/hg38_exon_bounds_all.pkl"
+  exon_bounds = annotator.load_keys(exon_bounds_path, max_chroms=max_chroms)
   fill_char = "NA"
   meta_df =  pd.read_csv("/oak/stanford/groups/horence/Roozbeh/single_cell_project/utility_files/meta_data/Tabula_Sapiens/TS_Pilot_Smartseq_metadata.csv") 
   plate = out_file.split("/")[-2].split("_")[0]
@@ -484,6 +487,7 @@ def write_class_file(junc_read_dict,out_file, single, genomic_alignments, tenX,
 #             'qualR1A', 'qualR1B', 'qualR2A', 'qualR2B', 'readLenR1', 'readLenR2', "MDR1A", "MDR1B", "MDR2A", "MDR2B", 
 #             'nmmR1A', 'nmmR1B', 'nmmR2A', 'nmmR2B', 'cigarR1A', 'cigarR1B','cigarR2A','cigarR2B', 'MR1A', 'MR1B','MR2A','MR2B',]
   out.write("\t".join(columns) + "\n")
+  junc_anns = annotate_refnames((reads[0].refName for junc in junc_read_dict.values() for reads in junc.values()), exon_bounds, splices)
 #  out_dict = {c : [] for c in columns}
   out_dict = {}
   for junc in junc_read_dict.keys():
@@ -548,10 +552,7 @@ def write_class_file(junc_read_dict,out_file, single, genomic_alignments, tenX,
         out_dict["juncPosR1A"] = split_ref[0].split(":")[2]
         out_dict["juncPosR1B"] = split_ref[1].split(":")[2]
         out_dict["readClassR1"] = split_ref[2]
-        out_dict["splice_ann"] = splice_ann(out_dict, splices)
-        out_dict["exon_annR1A"] = exon1(out_dict, exon_bounds)
-        out_dict["exon_annR1B"] = exon2(out_dict, exon_bounds)
-        out_dict["both_ann"] = out_dict["exon_annR1A"] & out_dict["exon_annR1B"]
+        out_dict["splice_ann"], out_dict["exon_annR1A"], out_dict["exon_annR1B"], out_dict["both_ann"] = junc_anns[r1.refName]
 
         if out_dict["readClassR1"] == "fus":
           out_dict["spliceDist"] = "NA"
@@ -753,7 +754,8 @@ def write_class_file(junc_read_dict,out_file, single, genomic_alignments, tenX,
 def main():
   t0 = time.time()
   parser = argparse.ArgumentParser(description="create class input file")
-  parser.add_argument("-g", "--gtf_path", help="the path to the gtf file to use for annotation")
+  parser.add_argument("-g", "--gtf_path", help="the path to the gtf file to use for annotation if the assembly has no annotator yet")
+  parser.add_argument("-c", "--check_gtf", action="store_true", help="hash the gtf contents even if its size and mtime haven't changed since it was cached")
   parser.add_argument("-a", "--assembly", help="The name of the assembly to pre-load annotation (so, mm10 for the 10th mouse assembly)")
   parser.add_argument("-i", "--input_path", help="the prefix to the STAR Aligned.out.sam and Chimeric.out.sam directory")
   parser.add_argument("-I", "--input_file",help="specify file name of different format",default="")
@@ -761,6 +763,7 @@ def main():
   parser.add_argument("-t", "--tenX", action="store_true", help="indicate whether this is 10X data (with UMIs and barcodes)")
   parser.add_argument("-T", "--test", action="store_true", help="save dictionaries and don't write class input")
   parser.add_argument("-n", "--include_one_read", action="store_true",help="also save reads where only r1 maps")
+  parser.add_argument("-m", "--max_chroms", type=int, default=None, help="keep at most this many chromosomes of annotation in memory (loaded on first use)")
 #  include_one_read = True
 
 
@@ -772,16 +775,16 @@ def main():
 #  annotator_path = "{}annotators/pyensembl_{}.pkl".format(wrapper_path, args.assembly)
   annotator_path = "{}annotators/{}.pkl".format(wrapper_path, args.assembly)
 
-  if os.path.exists(annotator_path):
-    ann = pickle.load(open(annotator_path, "rb"))
+  if args.gtf_path and not annotator.has_annotator(annotator_path):
+    ann = annotator.cached_annotator(args.gtf_path, "{}annotators/cache/".format(wrapper_path), lazy=True, max_chroms=args.max_chroms, check_gtf=args.check_gtf)
   else:
-    ann = annotator.Annotator(args.gtf_path)
 #    ann = pyensembl.Genome(reference_name = args.assembly,
 #             annotation_name = "my_genome_features",
 #             gtf_path_or_url=args.gtf_path)
 #    ann.index()
 
-    pickle.dump(ann, open(annotator_path, "wb"))
+    ann = annotator.require_annotator(annotator_path, lazy=True, max_chroms=args.max_chroms)
+  ann.set_locus_cache()
   fastqIdStyle = "complete" 
 
   print("initiated annotator: {}".format(time.time() - t0))
@@ -825,6 +828,7 @@ def main():
   else:
     read_junc_dict, junc_read_dict, genomic_alignments = STAR_parseBAM(bamFile1, "r1", read_junc_dict, junc_read_dict, fastqIdStyle, ann)
     read_junc_dict, junc_read_dict, _ = STAR_parseBAM(bamFile2, "r2", read_junc_dict, junc_read_dict, fastqIdStyle, ann)
+  print("annotator locus cache", ann.locus_cache_info())
   
 
  # if regime == "priorityAlign":
@@ -856,7 +860,7 @@ def main():
     pickle.dump(read_junc_dict, open("{}read_junc_dict.pkl".format(args.input_path), "wb"))
     pickle.dump(junc_read_dict, open("{}junc_read_dict.pkl".format(args.input_path), "wb"))
   else:
-    write_class_file(junc_read_dict,"{}class_input_{}.tsv".format(args.input_path, "WithinBAM"), args.single, genomic_alignments, args.tenX, args.include_one_read)
+    write_class_file(junc_read_dict,"{}class_input_{}.tsv".format(args.input_path, "WithinBAM"), args.single, genomic_alignments, args.tenX, args.include_one_read, args.max_chroms, args.assembly)
     print("genomic alignments",genomic_alignments)
 #
 #time.time() - t0
@@ -1,7 +1,10 @@
 import argparse
+import array
 from collections import defaultdict
 import datetime
+import hashlib
 import math
+from multiprocessing import Pool
 import numpy as np
 import os
 import pandas as pd
@@ -29,208 +32,565 @@ def get_args():
   parser.add_argument("--assembly",choices = ["hg38","Mmur_3.0","chlSab_covid19","hg38_covid19_ercc"], help="which assembly to use to modify class input")
   parser.add_argument("--UMI_bar", action="store_true",help="extract UMI and barcode")
   parser.add_argument("--paired", action="store_true",help="run once with each read primary and concatenate the files")
+  parser.add_argument("--max_chroms", type=int, default=None, help="keep at most this many chromosomes of the annotator in memory (loaded on first use)")
+  parser.add_argument("--processes", type=int, default=1, help="parse the bams with this many processes (by contig if sorted and indexed, else by ranges of read names)")
+  parser.add_argument("--chunk_size", type=int, default=None, help="write the output in row groups of about this many reads instead of holding every read in memory (bams must be grouped by read name)")
+  parser.add_argument("--tsv", choices = ["plain","gz","none"], default="plain", help="also write the class input as a tsv (what the GLM script reads), a gzipped tsv, or only the parquet files")
 
 
   args = parser.parse_args()
   return args
 
-def extract_info_align(CI_dict,bam_read,suffix,bam_file, ann, UMI_bar, fill_char = np.nan):
+def extract_info_align(CI,bam_read,suffix,bam_file, UMI_bar, fill_char = np.nan):
   sec_dict = {True: 0, False: 1}
   if UMI_bar:
-    vals = bam_read.query_name.split("_")
-    CI_dict["barcode"].append(vals[-2])
-    CI_dict["UMI"].append(vals[-1])
+    # 10x names end in _barcode_UMI, so only the last two fields need splitting off
+    vals = bam_read.query_name.rsplit("_", 2)
+    CI.barcode.append(vals[-2])
+    CI.UMI.append(vals[-1])
   else:
-    CI_dict["barcode"].append(fill_char)
-    CI_dict["UMI"].append(fill_char)
-  CI_dict["id"].append(bam_read.query_name)
-  CI_dict["fileType" + suffix].append("Aligned")
-  CI_dict["readLen" + suffix].append(bam_read.query_length)
-  CI_dict["aScore{}A".format(suffix)].append(bam_read.get_tag("AS"))
-  CI_dict["NH{}A".format(suffix)].append(bam_read.get_tag("NH"))
-  CI_dict["HI{}A".format(suffix)].append(bam_read.get_tag("HI"))
-  CI_dict["nmm{}A".format(suffix)].append(nmm(bam_read.get_tag("MD")))
-  CI_dict["qual{}A".format(suffix)].append(bam_read.mapping_quality)
-  cigar1, cigar2 = split_cigar_align(bam_read.cigarstring)
-  M, S, I, D = get_SM(cigar1)
-  CI_dict["M{}A".format(suffix)].append(M)
-  CI_dict["S{}A".format(suffix)].append(S)
-  M, S, I, D = get_SM(cigar2)
-  CI_dict["M{}B".format(suffix)].append(M)
-  CI_dict["S{}B".format(suffix)].append(S)
-  CI_dict["cigar{}A".format(suffix)].append(cigar1)
-  CI_dict["cigar{}B".format(suffix)].append(cigar2)
+    CI.barcode.append(fill_char)
+    CI.UMI.append(fill_char)
+  CI.id.append(bam_read.query_name)
+  CI.read_key.append(read_key(bam_read.query_name))
+  CI.fileType.append("Aligned")
+  CI.readLen.append(bam_read.query_length)
+  CI.aScoreA.append(bam_read.get_tag("AS"))
+  CI.NHA.append(bam_read.get_tag("NH"))
+  CI.HIA.append(bam_read.get_tag("HI"))
+  CI.nmmA.append(nmm(bam_read.get_tag("MD")))
+  CI.qualA.append(bam_read.mapping_quality)
+  cigar1, cigar2, SM1, SM2, posA, posB = align_cigar(bam_read.cigartuples, bam_read.reference_start + 1, fill_char)
+  CI.MA.append(SM1[0])
+  CI.SA.append(SM1[1])
+  if isinstance(cigar2, str):
+    CI.MB.append(SM2[0])
+    CI.SB.append(SM2[1])
+  else:
+    CI.MB.append(null_int)
+    CI.SB.append(null_int)
+  CI.cigarA.append(cigar1)
+  CI.cigarB.append(cigar2)
   seq = bam_read.query_sequence
-  counts = count_stretch(seq)
-  CI_dict["AT_run_" + suffix].append(max(counts["A"],counts["T"]))
-  CI_dict["GC_run_" + suffix].append(max(counts["G"],counts["C"]))
-  CI_dict["max_run_" + suffix].append(max(counts.values()))
-  CI_dict["seq{}".format(suffix)].append(seq)
-  CI_dict["entropy" + suffix].append(float('{:.3f}'.format(entropy(seq))))
-  maxA, maxT, maxG, maxC = max_base(seq)
-  CI_dict["maxA_10mer" + suffix].append(maxA)
-  CI_dict["maxT_10mer" + suffix].append(maxT)
-  CI_dict["maxG_10mer" + suffix].append(maxG)
-  CI_dict["maxC_10mer" + suffix].append(maxC)
-
-  refName, chrA, geneA, posA, chrB, geneB, posB = readObj_refname(bam_read.flag, bam_read.cigarstring, bam_file.get_reference_name(bam_read.tid), bam_read.reference_start + 1, ann, fill_char)
-#   print("refName",refName)
-  CI_dict["refName_AB" + suffix].append(refName)
-  CI_dict["chr{}A".format(suffix)].append(chrA)
-  CI_dict["chr{}B".format(suffix)].append(chrB)
-  CI_dict["gene{}A".format(suffix)].append(geneA)
-  CI_dict["gene{}B".format(suffix)].append(geneB)
-  CI_dict["juncPos{}A".format(suffix)].append(int(posA))
+  CI.seq.append(seq)
+
+  # genes and refName are filled in for the whole chunk by annotate_junctions
+  chrA = bam_file.get_reference_name(bam_read.tid)
+  CI.chrA.append(chrA)
+  CI.juncPosA.append(int(posA))
   if np.isnan(posB):
-    CI_dict["juncPos{}B".format(suffix)].append(posB)
+    CI.chrB.append(fill_char)
+    CI.juncPosB.append(null_int)
+    CI.juncType.append(fill_char)
   else:
-    CI_dict["juncPos{}B".format(suffix)].append(int(posB))
-  CI_dict["read_strand{}A".format(suffix)].append(read_strand(bam_read.flag))
-  CI_dict["read_strand{}B".format(suffix)].append(fill_char)
-  CI_dict["flag{}A".format(suffix)].append(bam_read.flag)
-  CI_dict["flag{}B".format(suffix)].append(fill_char)
-
-  CI_dict["primary{}A".format(suffix)].append(sec_dict[bam_read.is_secondary])
-  CI_dict["primary{}B".format(suffix)].append(fill_char)
-  empty_cols = ["aScore{}B".format(suffix),"qual{}B".format(suffix),"NH{}B".format(suffix),"nmm{}B".format(suffix), "HI{}B".format(suffix)]
-  for c in empty_cols:
-    CI_dict[c].append(fill_char)
-  return CI_dict
-
-def extract_info_chim(CI_dict,bam_read1,bam_read2,suffix, bam_file, ann, UMI_bar, fill_char = np.nan):
+    CI.chrB.append(chrA)
+    CI.juncPosB.append(int(posB))
+    CI.juncType.append("lin")
+  CI.read_strandA.append(read_strand(bam_read.flag))
+  CI.read_strandB.append(fill_char)
+  CI.flagA.append(bam_read.flag)
+  CI.flagB.append(null_int)
+
+  CI.primaryA.append(sec_dict[bam_read.is_secondary])
+  CI.primaryB.append(null_int)
+  for c in [CI.aScoreB, CI.qualB, CI.NHB, CI.nmmB, CI.HIB]:
+    c.append(null_int)
+  return CI
+
+def extract_info_chim(CI,bam_read1,bam_read2,suffix, bam_file, UMI_bar, fill_char = np.nan):
   assert bam_read1.query_name == bam_read2.query_name
   sec_dict = {True: 0, False: 1}
   if UMI_bar:
-    vals = bam_read1.query_name.split("_")
-    CI_dict["barcode"].append(vals[-2])
-    CI_dict["UMI"].append(vals[-1])
+    vals = bam_read1.query_name.rsplit("_", 2)
+    CI.barcode.append(vals[-2])
+    CI.UMI.append(vals[-1])
   else:
-    CI_dict["barcode"].append(fill_char)
-    CI_dict["UMI"].append(fill_char)
+    CI.barcode.append(fill_char)
+    CI.UMI.append(fill_char)
   reads = [bam_read1,bam_read2]
-  CI_dict["fileType" + suffix].append("Chimeric")
-  halves = ["A","B"]
-  CI_dict["id"].append(bam_read1.query_name)
+  CI.fileType.append("Chimeric")
+  CI.id.append(bam_read1.query_name)
+  CI.read_key.append(read_key(bam_read1.query_name))
   
-  CI_dict["readLen" + suffix].append(bam_read1.query_length)
+  CI.readLen.append(bam_read1.query_length)
   
   seq = bam_read1.query_sequence
-  counts = count_stretch(seq)
-  CI_dict["AT_run_" + suffix].append(max(counts["A"],counts["T"]))
-  CI_dict["GC_run_" + suffix].append(max(counts["G"],counts["C"]))
-  CI_dict["max_run_" + suffix].append(max(counts.values()))
-  CI_dict["seq{}".format(suffix)].append(seq)
-  CI_dict["entropy" + suffix].append(float('%3.f'%(entropy(seq))))
-  maxA, maxT, maxG, maxC = max_base(seq)
-  CI_dict["maxA_10mer" + suffix].append(maxA)
-  CI_dict["maxT_10mer" + suffix].append(maxT)
-  CI_dict["maxG_10mer" + suffix].append(maxG)
-  CI_dict["maxC_10mer" + suffix].append(maxC)
-
-  refName, chrA, geneA, posA, chrB, geneB, posB  = chim_refName([x.flag for x in reads], [x.cigarstring for x in reads], [x.reference_start + 1 for x in reads], [bam_file.get_reference_name(x.tid) for x in reads], ann)
-  CI_dict["refName_AB" + suffix].append(refName)
-#   split_ref = refName.split("|")
-  CI_dict["chr{}A".format(suffix)].append(chrA)
-  CI_dict["chr{}B".format(suffix)].append(chrB)
-  CI_dict["gene{}A".format(suffix)].append(geneA)
-  CI_dict["gene{}B".format(suffix)].append(geneB)
-  CI_dict["juncPos{}A".format(suffix)].append(int(posA))
-  CI_dict["juncPos{}B".format(suffix)].append(int(posB))
-  for i in range(2):
-    CI_dict["aScore{}{}".format(suffix,halves[i])].append(reads[i].get_tag("AS"))
-    CI_dict["qual{}{}".format(suffix,halves[i])].append(reads[i].mapping_quality)
-    CI_dict["NH{}{}".format(suffix,halves[i])].append(reads[i].get_tag("NH"))
-    CI_dict["HI{}{}".format(suffix,halves[i])].append(reads[i].get_tag("HI"))
-    CI_dict["nmm{}{}".format(suffix,halves[i])].append(nmm(reads[i].get_tag("MD")))
-    cigar = split_cigar_chim(reads[i].cigarstring)
-    M, S, I, D = get_SM(cigar)
-    CI_dict["M{}{}".format(suffix,halves[i])].append(M)
-    CI_dict["S{}{}".format(suffix,halves[i])].append(S)
-    CI_dict["cigar{}{}".format(suffix,halves[i])].append(cigar)
-    CI_dict["read_strand{}{}".format(suffix,halves[i])].append(read_strand(reads[i].flag))
-    CI_dict["flag{}{}".format(suffix,halves[i])].append(reads[i].flag)
-
-    CI_dict["primary{}{}".format(suffix,halves[i])].append(sec_dict[reads[i].is_secondary])
-  return CI_dict
-
-def get_final_df(bam_files,j,suffixes,ann,UMI_bar,t0,assembly):
-  CI_dfs = []
-  for i in range(len(bam_files)):
-    if i == 1:
-      read_ids = set(CI_dfs[0]["id"])
-    else:
-      read_ids = set()
-    suffix = suffixes[i]
-    col_bases = ["aScore","M","S","nmm","qual","NH","HI","cigar", "juncPos", "gene", "chr", "read_strand","primary","flag"]
-    columns = ["id","readLen" + suffix, "fileType" + suffix,"seq" + suffix,"AT_run_" + suffix,"GC_run_" + suffix,
-               "max_run_" + suffix,"entropy" + suffix,"refName_AB" + suffix, "UMI","barcode","maxA_10mer" + suffix,"maxT_10mer" + suffix,"maxG_10mer" + suffix,"maxC_10mer" + suffix]
-    for c in col_bases:
-  #     for r in ["R1"]:
-      for l in ["A","B"]:
-        columns.append("{}{}{}".format(c,suffix,l))
-    CI_dict = {c : [] for c in columns}
-    count = 0
-    first = False
-    if i == 0:
-      genomic_alignments = {}
-    alignFile = pysam.AlignmentFile(bam_files[i])
-    # columns
-    for bam_read in alignFile.fetch(until_eof=True):
-  #     suffix = "R1"
-
-      # make sure read is mapped
-      if not bam_read.is_unmapped:
-        if (i == 0) or (not bam_read.is_secondary and bam_read.query_name in read_ids):
-          # it's a chimeric alignment and we need another line from it
-          if bam_read.has_tag("ch") and not first:
-                prev_read = bam_read
-                first = True
+  CI.seq.append(seq)
+
+  rnames = [bam_file.get_reference_name(x.tid) for x in reads]
+  cigars = [chim_cigar(x.cigartuples) for x in reads]
+  posA, posB, juncType = chim_junction([x.flag for x in reads], [cigar[2] for cigar in cigars], [x.reference_start + 1 for x in reads], rnames)
+  CI.chrA.append(rnames[0])
+  CI.chrB.append(rnames[1])
+  CI.juncPosA.append(posA)
+  CI.juncPosB.append(posB)
+  CI.juncType.append(juncType)
+  for read, (cigar, SM, ref_len), half in zip(reads, cigars, CI.halves):
+    half.aScore.append(read.get_tag("AS"))
+    half.qual.append(read.mapping_quality)
+    half.NH.append(read.get_tag("NH"))
+    half.HI.append(read.get_tag("HI"))
+    half.nmm.append(nmm(read.get_tag("MD")))
+    half.M.append(SM[0])
+    half.S.append(SM[1])
+    half.cigar.append(cigar)
+    half.read_strand.append(read_strand(read.flag))
+    half.flag.append(read.flag)
+
+    half.primary.append(sec_dict[read.is_secondary])
+  return CI
+
+def CI_columns(suffix):
+  col_bases = ["aScore","M","S","nmm","qual","NH","HI","cigar", "juncPos", "gene", "chr", "read_strand","primary","flag"]
+  columns = ["id","readLen" + suffix, "fileType" + suffix,"seq" + suffix,"AT_run_" + suffix,"GC_run_" + suffix,
+             "max_run_" + suffix,"entropy" + suffix,"refName_AB" + suffix, "UMI","barcode","maxA_10mer" + suffix,"maxT_10mer" + suffix,"maxG_10mer" + suffix,"maxC_10mer" + suffix,"juncType" + suffix]
+  for c in col_bases:
+#     for r in ["R1"]:
+    for l in ["A","B"]:
+      columns.append("{}{}{}".format(c,suffix,l))
+  # only used to match up reads, dropped in finish_final_df
+  columns.append("read_key")
+  return columns
+
+def read_key(name):
+  """64-bit key of a read name, used in place of the name for sets, lookups and joins (the same in every process, unlike hash)"""
+  return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "little", signed=True)
+
+class ReadScores:
+  """Best genomic alignment score of every read, by read_key
+
+  Scores are appended as they're read, including one per alignment of a multimapper, and only
+  reduced to the best per read in lookup, so the reads' names aren't held in a dict.
+  """
+  def __init__(self):
+    self.keys = array.array("q")
+    self.scores = array.array("q")
+
+  def add(self, key, score):
+    self.keys.append(key)
+    self.scores.append(score)
+
+  def extend(self, other):
+    self.keys.extend(other.keys)
+    self.scores.extend(other.scores)
+
+  def lookup(self, keys):
+    """Whether each of keys has a genomic alignment, and its best score where it does"""
+    all_keys = np.frombuffer(self.keys, dtype=np.int64)
+    all_scores = np.frombuffer(self.scores, dtype=np.int64)
+    order = np.lexsort((all_scores, all_keys))
+    all_keys = all_keys[order]
+    last = np.append(all_keys[1:] != all_keys[:-1], True)
+    all_keys = all_keys[last]
+    all_scores = all_scores[order][last]
+    keys = np.asarray(keys, dtype=np.int64)
+    if len(all_keys) == 0:
+      return np.zeros(len(keys), dtype=bool), np.zeros(len(keys), dtype=np.int64)
+    pos = np.minimum(np.searchsorted(all_keys, keys), len(all_keys) - 1)
+    return all_keys[pos] == keys, all_scores[pos]
+
+# stands in for a missing value in the integer columns of a CIBuilder
+null_int = np.iinfo(np.int64).min
+
+class CIHalf:
+  """The A or B columns of a CIBuilder under their base names, so both halves of a chimeric read fill in one loop"""
+  def __init__(self, CI, half):
+    for base in CIBuilder.half_ints + CIBuilder.half_objects:
+      setattr(self, base, getattr(CI, base + half))
+
+class CIBuilder:
+  """The CI_columns of one bam, filled read by read by extract_info_align and extract_info_chim
+
+  Columns are attributes named without the suffix (id, readLen, aScoreA) so appending a read needs
+  no key formatting or dict lookups. Integer columns are int64 arrays holding null_int where a value
+  is missing, strings are lists.
+  """
+  half_ints = ["aScore","M","S","nmm","qual","NH","HI","juncPos","primary","flag"]
+  half_objects = ["cigar","chr","read_strand"]
+  read_ints = ["readLen","read_key"]
+  read_objects = ["id","UMI","barcode","fileType","seq","juncType"]
+
+  def __init__(self, suffix):
+    self.suffix = suffix
+    self.int_names = self.read_ints + [c + l for c in self.half_ints for l in ["A","B"]]
+    self.object_names = self.read_objects + [c + l for c in self.half_objects for l in ["A","B"]]
+    for name in self.int_names:
+      setattr(self, name, array.array("q"))
+    for name in self.object_names:
+      setattr(self, name, [])
+    self.halves = [CIHalf(self, "A"), CIHalf(self, "B")]
+
+  def __len__(self):
+    return len(self.id)
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    del state["halves"]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self.halves = [CIHalf(self, "A"), CIHalf(self, "B")]
+
+  def column(self, name):
+    """CI_columns name of the attribute name"""
+    if name in ["id","UMI","barcode","read_key"]:
+      return name
+    if name[:-1] in self.half_ints + self.half_objects:
+      return name[:-1] + self.suffix + name[-1]
+    return name + self.suffix
+
+  def extend(self, other):
+    for name in self.int_names + self.object_names:
+      getattr(self, name).extend(getattr(other, name))
+
+  def take(self, rows, suffix = None):
+    """A CIBuilder of the given rows (a boolean mask or row numbers), under another suffix if given"""
+    CI = CIBuilder(self.suffix if suffix is None else suffix)
+    rows = np.asarray(rows)
+    if rows.dtype == bool:
+      rows = np.flatnonzero(rows)
+    for name in self.int_names:
+      getattr(CI, name).frombytes(np.frombuffer(getattr(self, name), dtype=np.int64)[rows].tobytes())
+    for name in self.object_names:
+      getattr(CI, name).extend(map(getattr(self, name).__getitem__, rows.tolist()))
+    return CI
+
+  def to_dict(self):
+    """CI_dict of the reads so far
+
+    The dtypes are the ones a dict of lists gave: an integer column with a missing value is float64
+    with NaN and strings are object. The written types come from class_input_schema.
+    """
+    CI_dict = {c : [] for c in CI_columns(self.suffix)}
+    if len(self) == 0:
+      return CI_dict
+    for name in self.int_names:
+      values = np.frombuffer(getattr(self, name), dtype=np.int64).copy()
+      missing = values == null_int
+      if missing.any():
+        values = values.astype(np.float64)
+        values[missing] = np.nan
+      CI_dict[self.column(name)] = values
+    for name in self.object_names:
+      CI_dict[self.column(name)] = getattr(self, name)
+    return CI_dict
+
+def parse_bam(bam_file, suffix, UMI_bar, read_ids = None, chunk_size = None, start = None, end = None):
+  """Junctional reads of a bam as (CIBuilder, genomic_alignments), one pair per chunk of about chunk_size reads
+
+  With read_ids (a set of read_key) this is the mate bam: only primary alignments of those reads are kept and genomic
+  alignments are kept as rows. Chunks only end between read names, so every alignment of a read
+  (and both halves of a chimeric read) lands in the same chunk of a bam grouped by read name.
+  start and end limit it to a range of virtual offsets from bam_read_name_ranges.
+  """
+  CI = CIBuilder(suffix)
+  genomic_alignments = ReadScores()
+  first = False
+  last_name = None
+  alignFile = pysam.AlignmentFile(bam_file)
+  if start is None:
+    bam_reads = alignFile.fetch(until_eof=True)
+  else:
+    bam_reads = bam_range(alignFile, start, end)
+  # columns
+  for bam_read in bam_reads:
+#     suffix = "R1"
+    if chunk_size is not None and len(CI) >= chunk_size and not first and bam_read.query_name != last_name:
+      yield CI, genomic_alignments
+      CI = CIBuilder(suffix)
+      genomic_alignments = ReadScores()
+    last_name = bam_read.query_name
+
+    # make sure read is mapped
+    if not bam_read.is_unmapped:
+      if (read_ids is None) or (not bam_read.is_secondary and read_key(bam_read.query_name) in read_ids):
+        # it's a chimeric alignment and we need another line from it
+        if bam_read.has_tag("ch") and not first:
+              prev_read = bam_read
+              first = True
+        else:
+
+          # add info from chimeric read
+          if bam_read.has_tag("ch"):
+
+            # note: removing chim for this test ONLY; uncomment after
+            CI = extract_info_chim(CI,prev_read,bam_read,suffix, alignFile, UMI_bar)
+            first = False
+
+          # add info from align read
+          elif "N" in bam_read.cigarstring:
+            CI = extract_info_align(CI,bam_read,suffix,alignFile, UMI_bar)
+
+          # save genomic alignment information
           else:
-
-            # add info from chimeric read
-            if bam_read.has_tag("ch"):
-              count += 1
-
-              # note: removing chim for this test ONLY; uncomment after
-              CI_dict = extract_info_chim(CI_dict,prev_read,bam_read,suffix, alignFile, ann, UMI_bar)
-              first = False
-
-            # add info from align read
-            elif "N" in bam_read.cigarstring:
-              count += 1
-              CI_dict = extract_info_align(CI_dict,bam_read,suffix,alignFile, ann, UMI_bar)
-
-            # save genomic alignment information
+            if read_ids is None:
+              genomic_alignments.add(read_key(bam_read.query_name), bam_read.get_tag("AS"))
             else:
-              if i == 0:
-                if bam_read.query_name not in genomic_alignments:
-                  genomic_alignments[bam_read.query_name] = bam_read.get_tag("AS")
-                else:
-                  genomic_alignments[bam_read.query_name] = max(bam_read.get_tag("AS"), genomic_alignments[bam_read.query_name])
-              else:
-                CI_dict = extract_info_align(CI_dict,bam_read,suffix,alignFile, ann, UMI_bar)
-  #     if count == 10000:
-  #       continue
-    CI_df = pd.DataFrame.from_dict(CI_dict)
-    if i == 0:
-      genomic_alignments = defaultdict(lambda: np.nan,genomic_alignments)
-
-      CI_df["genomicAlignmentR1"] = 0
-      # print(CI_df.loc[CI_df["id"].isin(genomic_alignments)].shape)
-      CI_df.loc[CI_df["id"].isin(genomic_alignments),"genomicAlignmentR1"] = 1
-      CI_df["genomic_aScoreR1"] = CI_df["id"].map(genomic_alignments)
-      CI_df["spliceDist"] = abs(CI_df["juncPosR1A"] - CI_df["juncPosR1B"])
-    CI_dfs.append(CI_df)
-  if len(bam_files) == 2:
-    final_df = pd.merge(left=CI_dfs[0],right=CI_dfs[1][[c for c in CI_dfs[1].columns if c not in ["UMI","barcode","seqR2"]]],how="left",left_on="id",right_on="id")
+              CI = extract_info_align(CI,bam_read,suffix,alignFile, UMI_bar)
+#     if count == 10000:
+#       continue
+  yield CI, genomic_alignments
+
+# reads the mate bam is filtered on, handed to the contig workers once when the pool starts
+shard_read_ids = None
+
+def set_shard_read_ids(read_ids):
+  global shard_read_ids
+  shard_read_ids = read_ids
+
+def parse_contig(shard):
+  """parse_bam over one contig of an indexed bam; chimeric records are returned as SAM text to pair up later"""
+  bam_file, contig, suffix, UMI_bar = shard
+  CI = CIBuilder(suffix)
+  genomic_alignments = ReadScores()
+  chim_records = []
+  alignFile = pysam.AlignmentFile(bam_file)
+  for bam_read in alignFile.fetch(contig):
+    if bam_read.is_unmapped:
+      continue
+    if shard_read_ids is not None and (bam_read.is_secondary or read_key(bam_read.query_name) not in shard_read_ids):
+      continue
+    if bam_read.has_tag("ch"):
+      chim_records.append(bam_read.to_string())
+    elif "N" in bam_read.cigarstring:
+      CI = extract_info_align(CI,bam_read,suffix,alignFile, UMI_bar)
+    elif shard_read_ids is None:
+      genomic_alignments.add(read_key(bam_read.query_name), bam_read.get_tag("AS"))
+    else:
+      CI = extract_info_align(CI,bam_read,suffix,alignFile, UMI_bar)
+  return CI, genomic_alignments, chim_records
+
+def read_offset(bam_read):
+  """Where the aligned part of a record starts in the read as sequenced"""
+  cigar = bam_read.cigartuples
+  if bam_read.is_reverse:
+    cigar = cigar[::-1]
+  offset = 0
+  for op, length in cigar:
+    if op not in [4, 5]:
+      break
+    offset += length
+  return offset
+
+def parse_bam_parallel(bam_file, suffix, UMI_bar, processes, read_ids = None):
+  """parse_bam for a coordinate sorted, indexed bam, with one task per contig over a process pool"""
+  alignFile = pysam.AlignmentFile(bam_file)
+  CI = CIBuilder(suffix)
+  genomic_alignments = ReadScores()
+  chim_reads = defaultdict(list)
+  with Pool(processes, initializer=set_shard_read_ids, initargs=(read_ids,)) as pool:
+    for shard_CI, shard_genomic, shard_chim in pool.imap(parse_contig, [(bam_file, contig, suffix, UMI_bar) for contig in alignFile.references]):
+      CI.extend(shard_CI)
+      genomic_alignments.extend(shard_genomic)
+      for record in shard_chim:
+        bam_read = pysam.AlignedSegment.fromstring(record, alignFile.header)
+        group = chim_reads[(bam_read.query_name, bam_read.get_tag("HI"))]
+        group.append((read_offset(bam_read), bam_read.is_supplementary, len(group), bam_read))
+
+  # the two halves of a chimeric alignment can be on different contigs, so they are paired by read
+  # name and HI here. STAR writes them in the order they cover the read as sequenced, whatever strand
+  # each is on; halves starting at the same offset keep the representative (not supplementary) first,
+  # then their order in the sorted bam
+  for key, group in chim_reads.items():
+    bam_reads = [bam_read for offset, supplementary, position, bam_read in sorted(group, key=lambda half: half[:3])]
+    for k in range(0, len(bam_reads) - 1, 2):
+      CI = extract_info_chim(CI,bam_reads[k],bam_reads[k + 1],suffix, alignFile, UMI_bar)
+  return CI, genomic_alignments
+
+def parse_range(shard):
+  """parse_bam over one read-name-aligned range of virtual offsets"""
+  bam_file, start, end, suffix, UMI_bar = shard
+  return next(parse_bam(bam_file, suffix, UMI_bar, read_ids=shard_read_ids, start=start, end=end))
+
+def parse_bam_ranges(bam_file, suffix, UMI_bar, processes, read_ids = None):
+  """parse_bam for a bam grouped by read name (STAR's unsorted output), split into ranges over a process pool
+
+  The ranges never split a read, so chimeric halves and multimappers are handled exactly as in a
+  single pass, and the shards are merged back in file order.
+  """
+  CI = CIBuilder(suffix)
+  genomic_alignments = ReadScores()
+  ranges = bam_read_name_ranges(bam_file, 4 * processes)
+  with Pool(processes, initializer=set_shard_read_ids, initargs=(read_ids,)) as pool:
+    for shard_CI, shard_genomic in pool.imap(parse_range, [(bam_file, start, end, suffix, UMI_bar) for start, end in ranges]):
+      CI.extend(shard_CI)
+      genomic_alignments.extend(shard_genomic)
+  return CI, genomic_alignments
+
+def parallel_mode(bam_file):
+  """"contig" for sorted, indexed bams, "range" for bams grouped by read name, None if neither"""
+  alignFile = pysam.AlignmentFile(bam_file)
+  if alignFile.header.to_dict().get("HD", {}).get("SO") != "coordinate":
+    return "range"
+  if alignFile.has_index():
+    return "contig"
+  return None
+
+def read_bam(bam_file, suffix, UMI_bar, processes = 1, read_ids = None):
+  """CIBuilder and genomic alignment scores of a whole bam, in parallel where the bam allows it"""
+  mode = None
+  if processes > 1:
+    mode = parallel_mode(bam_file)
+    if mode is None:
+      print("{} is sorted by coordinate but not indexed, so it is read on one core".format(bam_file))
+  if mode == "contig":
+    return parse_bam_parallel(bam_file, suffix, UMI_bar, processes, read_ids)
+  if mode == "range":
+    return parse_bam_ranges(bam_file, suffix, UMI_bar, processes, read_ids)
+  return next(parse_bam(bam_file, suffix, UMI_bar, read_ids=read_ids))
+
+class BamRoles:
+  """One bam of a paired run parsed once, for its rows as the first bam and as the mate bam
+
+  Rows of either role are in CI, with first_rows and mate_rows marking the ones parse_bam makes in
+  each role and offsets giving the virtual offset of every row. As a mate the bam also keeps its
+  primary genomic alignments, which are most of the bam but only needed for the other bam's junction
+  reads, so those are only located (by virtual offset and read_key) and read in mate().
+  """
+  def __init__(self, bam_file, UMI_bar):
+    self.bam_file = bam_file
+    self.UMI_bar = UMI_bar
+    self.CI = CIBuilder("R1")
+    self.first_rows = array.array("b")
+    self.mate_rows = array.array("b")
+    self.offsets = array.array("q")
+    self.genomic_alignments = ReadScores()
+    self.genomic_offsets = array.array("q")
+    self.genomic_keys = array.array("q")
+
+  def extend(self, other):
+    self.CI.extend(other.CI)
+    for name in ["first_rows","mate_rows","offsets","genomic_offsets","genomic_keys"]:
+      getattr(self, name).extend(getattr(other, name))
+    self.genomic_alignments.extend(other.genomic_alignments)
+
+  def first(self, suffix):
+    """CIBuilder and genomic alignment scores of the bam as the first bam"""
+    return self.CI.take(np.frombuffer(self.first_rows, dtype=np.int8).astype(bool), suffix), self.genomic_alignments
+
+  def mate(self, read_keys, suffix):
+    """CIBuilder of the bam as the mate of a bam whose junction reads have read_keys, in file order"""
+    mates = np.isin(np.frombuffer(self.CI.read_key, dtype=np.int64), read_keys)
+    rows = np.flatnonzero(np.frombuffer(self.mate_rows, dtype=np.int8).astype(bool) & mates)
+    CI = self.CI.take(rows, suffix)
+    genomic = np.isin(np.frombuffer(self.genomic_keys, dtype=np.int64), read_keys)
+    genomic_offsets = np.frombuffer(self.genomic_offsets, dtype=np.int64)[genomic]
+
+    alignFile = pysam.AlignmentFile(self.bam_file)
+    for offset in genomic_offsets.tolist():
+      # a seek inflates its block again, so nearby records are read up to instead
+      if offset < alignFile.tell() or (offset >> 16) - (alignFile.tell() >> 16) > 1 << 16:
+        alignFile.seek(offset)
+      while alignFile.tell() < offset:
+        next(alignFile)
+      CI = extract_info_align(CI,next(alignFile),suffix,alignFile, self.UMI_bar)
+
+    # the genomic alignments go back between the other rows
+    offsets = np.concatenate([np.frombuffer(self.offsets, dtype=np.int64)[rows], genomic_offsets])
+    return CI.take(np.argsort(offsets, kind="stable"))
+
+def parse_bam_roles(bam_file, UMI_bar, start = None, end = None):
+  """BamRoles of a bam grouped by read name (or of a range of its virtual offsets), in a single pass
+
+  Follows parse_bam as the first bam and, without the read_ids filter, as the mate bam. Rows of both
+  roles, like primary spliced alignments, are only extracted once.
+  """
+  roles = BamRoles(bam_file, UMI_bar)
+  CI = roles.CI
+  # the first half of a chimeric alignment waiting for its second, as the first bam and as the mate
+  prev_reads = [None, None]
+  alignFile = pysam.AlignmentFile(bam_file)
+  if start is None:
+    start = alignFile.tell()
+  offset = start
+  for bam_read in bam_range(alignFile, start, end):
+    if not bam_read.is_unmapped:
+      # the mate bam only keeps primary alignments
+      in_role = [True, not bam_read.is_secondary]
+      if bam_read.has_tag("ch"):
+        pairs = []
+        for k in range(2):
+          if not in_role[k]:
+            continue
+          if prev_reads[k] is None:
+            prev_reads[k] = bam_read
+          else:
+            pairs.append((k, prev_reads[k]))
+            prev_reads[k] = None
+        if len(pairs) == 2 and pairs[0][1] is pairs[1][1]:
+          pairs = [(None, pairs[0][1])]
+        for k, prev_read in pairs:
+          CI = extract_info_chim(CI,prev_read,bam_read,"R1", alignFile, UMI_bar)
+          roles.first_rows.append(k != 1)
+          roles.mate_rows.append(k != 0)
+          roles.offsets.append(offset)
+      elif "N" in bam_read.cigarstring:
+        CI = extract_info_align(CI,bam_read,"R1",alignFile, UMI_bar)
+        roles.first_rows.append(True)
+        roles.mate_rows.append(in_role[1])
+        roles.offsets.append(offset)
+      else:
+        key = read_key(bam_read.query_name)
+        roles.genomic_alignments.add(key, bam_read.get_tag("AS"))
+        if in_role[1]:
+          roles.genomic_offsets.append(offset)
+          roles.genomic_keys.append(key)
+    offset = alignFile.tell()
+  return roles
+
+def parse_range_roles(shard):
+  """parse_bam_roles over one read-name-aligned range of virtual offsets"""
+  bam_file, start, end, UMI_bar = shard
+  return parse_bam_roles(bam_file, UMI_bar, start, end)
+
+def read_bam_roles(bam_file, UMI_bar, processes = 1):
+  """parse_bam_roles of a whole bam, split into ranges over a process pool if there's more than one process"""
+  if processes == 1 or parallel_mode(bam_file) != "range":
+    return parse_bam_roles(bam_file, UMI_bar)
+  roles = BamRoles(bam_file, UMI_bar)
+  ranges = bam_read_name_ranges(bam_file, 4 * processes)
+  with Pool(processes) as pool:
+    for shard_roles in pool.imap(parse_range_roles, [(bam_file, start, end, UMI_bar) for start, end in ranges]):
+      roles.extend(shard_roles)
+  return roles
+
+def junction_read_ids(bam_file):
+  """read_key of the reads parse_bam makes rows for in the first bam, without parsing them"""
+  read_ids = set()
+  for bam_read in pysam.AlignmentFile(bam_file).fetch(until_eof=True):
+    if not bam_read.is_unmapped and (bam_read.has_tag("ch") or "N" in bam_read.cigarstring):
+      read_ids.add(read_key(bam_read.query_name))
+  return read_ids
+
+def build_CI_df(CI, genomic_alignments, ann, suffix, first_bam):
+  CI_dict = add_seq_features(CI.to_dict(), suffix)
+  CI_df = pd.DataFrame.from_dict(annotate_junctions(CI_dict, ann, suffix))
+  if first_bam:
+    has_genomic, genomic_scores = genomic_alignments.lookup(CI_df["read_key"])
+    CI_df["genomicAlignmentR1"] = has_genomic.astype(np.int64)
+    CI_df["genomic_aScoreR1"] = pd.Series(genomic_scores, index=CI_df.index).where(has_genomic)
+    if len(CI_df) == 0:
+      # the dtype mapping names to scores gave an empty chunk
+      CI_df["genomic_aScoreR1"] = CI_df["genomic_aScoreR1"].astype(object)
+    CI_df["spliceDist"] = abs(CI_df["juncPosR1A"] - CI_df["juncPosR1B"])
+    # integer forms of the barcode and UMI to group cells by; unpack_bases gives back the strings
+    CI_df["barcode_packed"] = pack_bases(CI_df["barcode"])
+    CI_df["UMI_packed"] = pack_bases(CI_df["UMI"])
+  return CI_df
+
+def finish_final_df(CI_df, mate_df, j, t0, assembly, ann, known_refnames = None):
+  """Join the mate reads, rename the junctions and split off the secondary alignments"""
+  if mate_df is not None:
+    final_df = pd.merge(left=CI_df,right=mate_df[[c for c in mate_df.columns if c not in ["id","UMI","barcode","seqR2"] + annotation_columns("R2")]],how="left",on="read_key")
     final_df["read_strand_compatible"] = 1
     final_df.loc[final_df["read_strandR1A"] == final_df["read_strandR2A"],"read_strand_compatible"] = 0
-    final_df["location_compatible"] = final_df.apply(get_loc_flag,axis=1)
+    final_df["location_compatible"] = loc_flags(final_df)
   else:
-    final_df = CI_dfs[0]
+    final_df = CI_df
   #  final_df.fillna(np.nan,inplace=True)
   float_cols = ["aScoreR1A","nmmR1A","qualR1A","NHR1A","primaryR1A","genomic_aScoreR1","HIR1A"]
-  if len(bam_files) == 2:
+  if mate_df is not None:
     float_cols += ["readLenR2","AT_run_R2",
                 "GC_run_R2","max_run_R2","aScoreR2A","aScoreR2B","MR2A","MR2B","SR2A","SR2B","nmmR2A","nmmR2B",
                 "qualR2A","qualR2B","NHR2A","NHR2B","juncPosR2A","juncPosR2B","primaryR2A","primaryR2B",  "HIR2A", "HIR2B"]
@@ -243,10 +603,12 @@ def get_final_df(bam_files,j,suffixes,ann,UMI_bar,t0,assembly):
   #    if str(str_dtype)[0] == "i":
   #      final_df[c] = final_df[c].astype("I" + str_dtype[1:])
 
-  final_df = modify_refnames(final_df, assembly) 
+  # read_key isn't written out
+  read_keys = final_df.pop("read_key")
+  final_df = modify_refnames(final_df, assembly, known_refnames, ann)
 
   print("ended modify", time.time() - t0)
-  final_df["max_id_priority"] = final_df["id"].map(final_df.groupby("id")["HIR1A"].min())
+  final_df["max_id_priority"] = final_df.groupby(read_keys)["HIR1A"].transform("min")
 
   #  for c in final_df.columns:
   #    if str(final_df[c].dtype)[0] == "I":
@@ -259,6 +621,44 @@ def get_final_df(bam_files,j,suffixes,ann,UMI_bar,t0,assembly):
 
   return primary, secondary
 
+def get_final_df(bam_files,j,suffixes,ann,UMI_bar,t0,assembly,processes = 1):
+  CI_df = build_CI_df(*read_bam(bam_files[0], suffixes[0], UMI_bar, processes), ann, suffixes[0], True)
+  mate_df = None
+  if len(bam_files) == 2:
+    mate_df = build_CI_df(*read_bam(bam_files[1], suffixes[1], UMI_bar, processes, read_ids=set(CI_df["read_key"].tolist())), ann, suffixes[1], False)
+  return finish_final_df(CI_df, mate_df, j, t0, assembly, ann)
+
+def get_paired_final_dfs(bam_files,suffixes,ann,UMI_bar,t0,assembly,processes = 1):
+  """get_final_df for both rounds of a paired run, reading each bam once
+
+  Round j has bam_files[j] as the first bam, and both rounds are made from the same BamRoles.
+  """
+  roles = [read_bam_roles(bam_file, UMI_bar, processes) for bam_file in bam_files]
+  final_dfs = []
+  for j in range(2):
+    print("bam_files",[bam_files[j], bam_files[1 - j]])
+    CI_df = build_CI_df(*roles[j].first(suffixes[0]), ann, suffixes[0], True)
+    mate_df = build_CI_df(roles[1 - j].mate(CI_df["read_key"].to_numpy(), suffixes[1]), None, ann, suffixes[1], False)
+    final_dfs.append(finish_final_df(CI_df, mate_df, j, t0, assembly, ann))
+  return final_dfs
+
+def write_final_chunks(bam_files,j,suffixes,ann,UMI_bar,t0,assembly,chunk_size,writers):
+  """get_final_df for one chunk of the first bam at a time, written to the primary and secondary writers
+
+  The mate bam of a paired run is still parsed whole, as the chunks of the first bam can need any of its reads.
+  """
+  mate_df = None
+  if len(bam_files) == 2:
+    mate_df = build_CI_df(*next(parse_bam(bam_files[1], suffixes[1], UMI_bar, read_ids=junction_read_ids(bam_files[0]))), ann, suffixes[1], False)
+
+  # junctions renamed in earlier chunks keep the name given by their first read
+  known_refnames = JunctionNames()
+  for CI, genomic_alignments in parse_bam(bam_files[0], suffixes[0], UMI_bar, chunk_size=chunk_size):
+    CI_df = build_CI_df(CI, genomic_alignments, ann, suffixes[0], True)
+    primary, secondary = finish_final_df(CI_df, mate_df, j, t0, assembly, ann, known_refnames)
+    writers[0].write(primary)
+    writers[1].write(secondary)
+
 def main():
   t0 = time.time()
   args = get_args()
@@ -270,25 +670,50 @@ def main():
   annotator_path = "{}annotators/{}.pkl".format(wrapper_path, args.assembly)
   if "hg38" in args.assembly:
     annotator_path = "/oak/stanford/groups/horence/Roozbeh/single_cell_project/scripts/STAR_wrapper/annotators/grch38.pkl"
-  ann = pickle.load(open(annotator_path, "rb"))
+  ann = annotator.require_annotator(annotator_path, lazy=True, max_chroms=args.max_chroms)
 
   suffixes = ["R1","R2"]
 
-  final_dfs = []
-  final_dfs_secondary = []
-  
+  if args.chunk_size is not None:
+    for bam_file in bam_files:
+      if pysam.AlignmentFile(bam_file).header.to_dict().get("HD", {}).get("SO") == "coordinate":
+        print("{} is sorted by coordinate, so its reads can't be chunked; reading it whole".format(bam_file))
+        args.chunk_size = None
+
   if args.paired:
     n_rounds = 2
   else:
     n_rounds = 1
 
-  for j in range(n_rounds):
-    if j == 1:
-      bam_files.reverse()
-    print("bam_files",bam_files)
-    primary, secondary = get_final_df(bam_files,j,suffixes,ann,args.UMI_bar,t0,args.assembly)
-    final_dfs.append(primary)
-    final_dfs_secondary.append(secondary)
+  # secondary alignments are always spilled as they come, as nothing else needs them
+  secondary_writer = ChunkWriter(args.outpath + "class_input_secondary.pq", tsv_file(args.outpath + "class_input_secondary", args.tsv), args.processes)
+  if args.chunk_size is not None:
+    writers = [ChunkWriter(args.outpath + "class_input.pq", tsv_file(args.outpath + "class_input", args.tsv), args.processes), secondary_writer]
+    for j in range(n_rounds):
+      if j == 1:
+        bam_files.reverse()
+      print("bam_files",bam_files)
+      write_final_chunks(bam_files,j,suffixes,ann,args.UMI_bar,t0,args.assembly,args.chunk_size,writers)
+    for writer in writers:
+      writer.close()
+    print("total time",datetime.timedelta(seconds=time.time() - t0))
+    return
+
+  final_dfs = []
+  
+  # both rounds of a paired run come from one pass over each bam, except for sorted bams parsed by contig
+  if args.paired and len(bam_files) == 2 and (args.processes == 1 or "contig" not in [parallel_mode(bam_file) for bam_file in bam_files]):
+    for primary, secondary in get_paired_final_dfs(bam_files,suffixes,ann,args.UMI_bar,t0,args.assembly,args.processes):
+      final_dfs.append(primary)
+      secondary_writer.write(secondary)
+  else:
+    for j in range(n_rounds):
+      if j == 1:
+        bam_files.reverse()
+      print("bam_files",bam_files)
+      primary, secondary = get_final_df(bam_files,j,suffixes,ann,args.UMI_bar,t0,args.assembly,args.processes)
+      final_dfs.append(primary)
+      secondary_writer.write(secondary)
 #  final_df = pd.concat(final_dfs,axis=0).reset_index(drop=True)
 
 
@@ -298,16 +723,16 @@ def main():
 
 #  final_df.to_parquet(args.outpath + "class_input_final.pq")
 
-  pd.concat(final_dfs,axis=0).reset_index(drop=True).to_parquet(args.outpath + "class_input.pq")
-  pd.concat(final_dfs_secondary,axis=0).reset_index(drop=True).to_parquet(args.outpath + "class_input_secondary.pq")
+  write_output(pd.concat(final_dfs,axis=0).reset_index(drop=True), args.outpath + "class_input.pq", tsv_file(args.outpath + "class_input", args.tsv), args.processes)
+  secondary_writer.close()
 
 #  final_df[final_df["HIR1A"] == final_df["max_id_priority"]].to_hdf(args.outpath + "class_input.h5", key="class_input")
 #  final_df[final_df["HIR1A"] != final_df["max_id_priority"]].to_hdf(args.outpath + "class_input_secondary.h5", key="class_input_secondary")
 
-  pd.concat(final_dfs,axis=0).reset_index(drop=True).to_csv(args.outpath + "class_input.tsv",sep="\t",index=False)
-  pd.concat(final_dfs_secondary,axis=0).reset_index(drop=True).to_csv(args.outpath + "class_input_secondary.tsv",sep="\t",index=False)
 #  final_df["juncPosR1A"] = final_df["juncPosR1A"].astype("Int32")
 #  final_df["juncPosR1B"] = final_df["juncPosR1B"].astype("Int32") 
 
   print("total time",datetime.timedelta(seconds=time.time() - t0))
-main()
+
+if __name__ == "__main__":
+  main()
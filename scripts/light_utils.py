@@ -1,212 +1,465 @@
 from collections import defaultdict
+import gzip
+import hashlib
 import math
+from multiprocessing import Pool
 import numpy as np
 import os
 import pandas as pd
 import pickle
+import pyarrow
+import pyarrow.parquet
 import pysam
 import re
+import shutil
+import struct
+import tempfile
+import zlib
 
 import sys
 #sys.path.insert(1, '/scratch/PI/horence/JuliaO/single_cell/STAR_wrapper/scripts/')
 import annotator
 
-def modify_refnames(CI, assembly):
-  swap_names = False
+def gene_strand_file(assembly):
   if "Mmur_3.0" in assembly:
-    gene_strand_info_file = "/oak/stanford/groups/horence/Roozbeh/single_cell_project/utility_files/Mmur3_gene_strand.txt"
+    return "/oak/stanford/groups/horence/Roozbeh/single_cell_project/utility_files/Mmur3_gene_strand.txt"
   elif "hg38" in assembly:
-    gene_strand_info_file = "/oak/stanford/groups/horence/Roozbeh/single_cell_project/utility_files/hg38_gene_strand.txt"
+    return "/oak/stanford/groups/horence/Roozbeh/single_cell_project/utility_files/hg38_gene_strand.txt"
   elif "covid" in assembly:
-    gene_strand_info_file = "/oak/stanford/groups/horence/Roozbeh/single_cell_project/utility_files/hg38_covid_gene_strand.txt"
-  gene_strand_info = pd.read_csv(gene_strand_info_file,sep="\t")
-  CI["HIR1B"] = CI["HIR1A"]
-#  CI = pd.read_csv("/oak/stanford/groups/horence/Roozbeh/single_cell_project/output/HLCA_171205_10X_cSM_10_cJOM_10_aSJMN_0_cSRGM_0/P1_3_S1_L001/test_class_input.tsv","\t")
-  CI_new = CI.drop_duplicates("refName_ABR1")
-  
-
-  CI_new["geneR1A"] = CI_new["geneR1A"].fillna("")
-  CI_new["geneR1B"] = CI_new["geneR1B"].fillna("")
-  CI_new.loc[CI_new["fileTypeR1"] == "Aligned","read_strandR1B"] = CI_new[CI_new["fileTypeR1"] == "Aligned"]["read_strandR1A"]
-  # CI_new["read_strandR1A_orig"] = CI_new["read_strandR1A"]
-  # CI_new["read_strandR1B_orig"] = CI_new["read_strandR1B"]
-  CI_new["gene_strandR1A"] = CI_new["refName_ABR1"].str.split("|").str[0].str.split(":").str[-1]
-  CI_new["gene_strandR1B"] = CI_new["refName_ABR1"].str.split("|").str[1].str.split(":").str[-1]
-  CI_new["numgeneR1A"] = CI_new["geneR1A"].str.split(",").str.len()#.astype("Int32") # the number of overlapping genes on the R1A side
-  CI_new[["numgeneR1A"]] = CI_new[["numgeneR1A"]].fillna(0)
-  CI_new["numgeneR1B"] = CI_new["geneR1B"].str.split(",").str.len()#.astype("Int32") # the number of overlapping genes on the R1B side
-  CI_new[["numgeneR1B"]] = CI_new[["numgeneR1B"]].fillna(0)
-  # display(CI_new[CI_new["id"] == "A00111:88:H55NYDMXX:1:1101:15365:8469_TATCAGGCATTATCTC_GCAACGGCAG"])
-  
+    return "/oak/stanford/groups/horence/Roozbeh/single_cell_project/utility_files/hg38_covid_gene_strand.txt"
+
+# GeneStrands read from the gene strand files of annotators built without one, by assembly
+gene_strand_tables = {}
+
+def gene_strands(assembly, ann = None):
+  """GeneStrands of the annotator, or of the assembly's gene strand file, read once per run"""
+  if ann is not None and ann.gene_strands is not None:
+    return ann.gene_strands
+  if assembly not in gene_strand_tables:
+    gene_strand_tables[assembly] = annotator.GeneStrands.from_table(pd.read_csv(gene_strand_file(assembly),sep="\t"), by_chrom=assembly == "Mmur_3.0")
+  return gene_strand_tables[assembly]
+
+# every junction type a refName can end in
+junc_types = ["lin","rev","sc","fus","err"]
+
+def rename_junctions(J, strands):
+  """The renamed sides of the junctions in J (one read of each), given the GeneStrands of the assembly,
+  with the junction type, refName_newR1 and junction_ids
+
+  Each side is narrowed to one gene: weird_genes are dropped from loci with several, a gene both
+  sides share wins, and otherwise the last gene does, or the one before it when the last one's
+  strand disagrees with the read's. The sides are then ordered by gene strand and the junction typed.
+  A junction that can't be named that way keeps the sides it was annotated with. The name is only
+  formatted from the finished columns.
+  """
+  def strand_of(genes, chrs):
+    return pd.Series(strands.lookup(genes, chrs if strands.chroms is not None else None), index=J.index, dtype=object)
+
+  aligned = J["fileTypeR1"] == "Aligned"
+  chimeric = J["fileTypeR1"] == "Chimeric"
+  chrs = {half : J["chrR1" + half] for half in "AB"}
+  pos = {half : J["juncPosR1" + half] for half in "AB"}
+  read_strands = {"A" : J["read_strandR1A"], "B" : J["read_strandR1B"].where(~aligned, J["read_strandR1A"])}
+  gene_strand = {half : J["gene_strand_ABR1" + half] for half in "AB"}
+  genes = {half : J["geneR1" + half].fillna("") for half in "AB"}
+  num_genes = {half : genes[half].str.split(",").str.len().fillna(0) for half in "AB"}
+
   weird_genes = ["SNORA","RP11","RP4-","SCARNA","DLEU2","SNORD","CTSLP2"]
   for weird_gene in weird_genes:
-    for suff in ["A","B"]:
-      ind = CI_new[((CI_new["numgeneR1" + suff] > 2) & (CI_new["geneR1" + suff].str.contains(weird_gene,na=False))) | ((CI_new["numgeneR1" + suff] > 1) & ~(CI_new["gene_strandR1" + suff] == "?") & (CI_new["geneR1" + suff].str.contains(weird_gene,na=False)))].index
-      CI_new.loc[ind,"geneR1" + suff] = CI_new.loc[ind,"geneR1" + suff].str.replace("{}[^,]*[,]".format(weird_gene),"",regex=True).str.replace(",{}.*".format(weird_gene),"")
-      CI_new.loc[ind,"numgeneR1" + suff] = CI_new.loc[ind,"geneR1" + suff].str.split(",").str.len()#.astype("Int32")
-  CI_new["shared_gene"] = [",".join([x for x in a.split(",") if x in b.split(",")]) for a,b in zip(CI_new["geneR1A"],CI_new["geneR1B"])]
-  # display(CI_new[CI_new["id"] == "A00111:88:H55NYDMXX:1:1101:15365:8469_TATCAGGCATTATCTC_GCAACGGCAG"])
-  
-  CI_new["num_shared_genes"] = CI_new["shared_gene"].str.split(",").str.len()
-  CI_new.loc[CI_new["shared_gene"] == "","num_shared_genes"] = 0
-  ind = CI_new[(CI_new["num_shared_genes"] > 0) & ((CI_new["numgeneR1A"] > 1) | (CI_new["numgeneR1B"] > 1))].index
-  # display(CI_new.loc[[67],"geneR1A"])
-  CI_new.loc[ind,"geneR1A"] = CI_new.loc[ind]["shared_gene"].str.split(",").str[-1]
-  CI_new.loc[ind,"geneR1B"] = CI_new.loc[ind]["shared_gene"].str.split(",").str[-1]
-  CI_new["geneR1A_uniq"] = CI_new["geneR1A"]
-  CI_new["geneR1B_uniq"] = CI_new["geneR1B"]
-  # display(CI_new[CI_new["id"] == "A00111:88:H55NYDMXX:1:1101:15365:8469_TATCAGGCATTATCTC_GCAACGGCAG"])
-  
-  ind = CI_new[(CI_new["numgeneR1A"] > 1) & (CI_new["num_shared_genes"] == 0)].index
-  CI_new.loc[ind,"geneR1A_uniq"] = CI_new.loc[ind]["geneR1A"].str.split(",").str[-1]
-  ind = CI_new[(CI_new["numgeneR1B"] > 1) & (CI_new["num_shared_genes"] == 0)].index
-  CI_new.loc[ind,"geneR1B_uniq"] = CI_new.loc[ind]["geneR1B"].str.split(",").str[-1]
-  for let in ["A","B"]:
-  
-    if assembly == "Mmur_3.0":
-      CI_new = CI_new.merge(gene_strand_info,how="left",left_on = ["geneR1{}_uniq".format(let),"chrR1{}".format(let)], right_on=["gene_name","chr"])
-      CI_new = CI_new.rename(columns={"strand" : "gene_strandR1{}_new".format(let)})
-      CI_new = CI_new.drop(["gene_name","chr"],axis=1)
-    else:
-      CI_new = CI_new.merge(gene_strand_info,how="left",left_on = ["geneR1{}_uniq".format(let)], right_on=["gene_name"])
-      CI_new = CI_new.rename(columns={"strand" : "gene_strandR1{}_new".format(let)})
-      CI_new = CI_new.drop(["gene_name"],axis=1)
-  ind = CI_new[((((CI_new["gene_strandR1A_new"] != CI_new["read_strandR1A"]) & (CI_new["gene_strandR1B_new"] == CI_new["read_strandR1B"])) | ((CI_new["gene_strandR1A_new"] == CI_new["read_strandR1A"]) & (~CI_new["gene_strandR1B_new"].isna()) & (CI_new["gene_strandR1B_new"] != CI_new["read_strandR1B"]))) & (CI_new["gene_strandR1A"] == "?") & (CI_new["num_shared_genes"] == 0)) & (CI_new["numgeneR1A"] > 1)].index
-  # display(CI_new[CI_new["id"] == "A00111:88:H55NYDMXX:1:1101:28601:21715_GTTTCTACAAGCGAGT_TAGTTCACTG"])
-  
-  CI_new.loc[ind,"geneR1A_uniq"] = CI_new.loc[ind]["geneR1A"].str.split(",").str[-2]
-  # display(CI_new[CI_new["id"] == "A00111:88:H55NYDMXX:1:1101:28601:21715_GTTTCTACAAGCGAGT_TAGTTCACTG"])
-  
-  CI_new = CI_new.drop(["gene_strandR1A_new"],axis=1)
-  if assembly == "Mmur_3.0":
-    CI_new = CI_new.merge(gene_strand_info,how="left",left_on = ["geneR1A_uniq","chrR1A"], right_on=["gene_name","chr"])
-    CI_new = CI_new.rename(columns={"strand" : "gene_strandR1A_new"})
-    ind = CI_new[(((CI_new["gene_strandR1A_new"] != CI_new["read_strandR1A"]) & (~CI_new["gene_strandR1A_new"].isna())  & (CI_new["gene_strandR1B_new"] == CI_new["read_strandR1B"])) | ((CI_new["gene_strandR1A_new"] == CI_new["read_strandR1A"]) & (CI_new["gene_strandR1B_new"] != CI_new["read_strandR1B"]))) & (CI_new["gene_strandR1B"] == "?") & (CI_new["num_shared_genes"] == 0) & (CI_new["numgeneR1B"] > 1)].index
-    CI_new.loc[ind,"geneR1B_uniq"] = CI_new.loc[ind]["geneR1B"].str.split(",").str[-2]
-    CI_new = CI_new.drop(["gene_strandR1B_new"],axis=1)
-    CI_new = CI_new.merge(gene_strand_info,how="left",left_on = ["geneR1B_uniq","chrR1B"], right_on=["gene_name","chr"])
-    CI_new = CI_new.rename(columns={"strand" : "gene_strandR1B_new"})
-  else:
-  #   display(CI_new[CI_new["id"] == "A00111:88:H55NYDMXX:1:1101:15365:8469_TATCAGGCATTATCTC_GCAACGGCAG"])
-  
-    CI_new = CI_new.merge(gene_strand_info,how="left",left_on = ["geneR1A_uniq"], right_on=["gene_name"])
-    CI_new = CI_new.drop(["gene_name"],axis=1)
-    CI_new = CI_new.rename(columns={"strand" : "gene_strandR1A_new"})
-    ind = CI_new[((((CI_new["gene_strandR1A_new"] != CI_new["read_strandR1A"]) & (~CI_new["gene_strandR1A_new"].isna()) & (CI_new["gene_strandR1B_new"] == CI_new["read_strandR1B"])) | ((CI_new["gene_strandR1A_new"] == CI_new["read_strandR1A"]) & (CI_new["gene_strandR1B_new"] != CI_new["read_strandR1B"]))) & (CI_new["gene_strandR1B"] == "?") & (CI_new["num_shared_genes"] == 0)) & (CI_new["numgeneR1B"] > 1)].index
-  #   display(CI_new[CI_new["id"] == "A00111:88:H55NYDMXX:1:1101:15365:8469_TATCAGGCATTATCTC_GCAACGGCAG"])
-  #   display(CI_new[CI_new["id"] == "A00111:88:H55NYDMXX:1:1101:28601:21715_GTTTCTACAAGCGAGT_TAGTTCACTG"])
-  
-    CI_new.loc[ind,"geneR1B_uniq"] = CI_new.loc[ind]["geneR1B"].str.split(",").str[-2]
-  #   display(CI_new[CI_new["id"] == "A00111:88:H55NYDMXX:1:1101:28601:21715_GTTTCTACAAGCGAGT_TAGTTCACTG"])
-  
-    CI_new = CI_new.drop(["gene_strandR1B_new"],axis=1)
-    CI_new = CI_new.merge(gene_strand_info,how="left",left_on = ["geneR1B_uniq"], right_on=["gene_name"])
-    CI_new = CI_new.rename(columns={"strand" : "gene_strandR1B_new"})
-  # display(CI_new[CI_new["id"] == "A00111:88:H55NYDMXX:1:1101:15365:8469_TATCAGGCATTATCTC_GCAACGGCAG"])
-  
+    for half in "AB":
+      has_weird = genes[half].str.contains(weird_gene,na=False)
+      ind = ((num_genes[half] > 2) & has_weird) | ((num_genes[half] > 1) & (gene_strand[half] != "?") & has_weird)
+      genes[half][ind] = genes[half][ind].str.replace("{}[^,]*[,]".format(weird_gene),"",regex=True).str.replace(",{}.*".format(weird_gene),"",regex=True)
+      num_genes[half][ind] = genes[half][ind].str.split(",").str.len()
+  shared = pd.Series([",".join([x for x in a.split(",") if x in b.split(",")]) for a,b in zip(genes["A"],genes["B"])], index=J.index, dtype=object)
+  num_shared = shared.str.split(",").str.len().where(shared != "", 0)
+  ind = (num_shared > 0) & ((num_genes["A"] > 1) | (num_genes["B"] > 1))
+  uniq = {}
+  for half in "AB":
+    genes[half][ind] = shared[ind].str.split(",").str[-1]
+    uniq[half] = genes[half].copy()
+    multi = (num_genes[half] > 1) & (num_shared == 0)
+    uniq[half][multi] = genes[half][multi].str.split(",").str[-1]
+
+  # fall back to the gene before the last when that makes the gene strands agree with the read
+  new_strand = {half : strand_of(uniq[half], chrs[half]) for half in "AB"}
+  agree = {half : new_strand[half] == read_strands[half] for half in "AB"}
+  ind = (((~agree["A"] & agree["B"]) | (agree["A"] & new_strand["B"].notna() & ~agree["B"])) & (gene_strand["A"] == "?") & (num_shared == 0) & (num_genes["A"] > 1))
+  uniq["A"][ind] = genes["A"][ind].str.split(",").str[-2]
+  new_strand["A"] = strand_of(uniq["A"], chrs["A"])
+  agree["A"] = new_strand["A"] == read_strands["A"]
+  ind = (((~agree["A"] & new_strand["A"].notna() & agree["B"]) | (agree["A"] & ~agree["B"])) & (gene_strand["B"] == "?") & (num_shared == 0) & (num_genes["B"] > 1))
+  uniq["B"][ind] = genes["B"][ind].str.split(",").str[-2]
+  new_strand["B"] = strand_of(uniq["B"], chrs["B"])
+
+  # a side without a known gene strand takes the one the read implies from the other side
   reverse = {"+" : "-", "-" : "+"}
   same = {"-" : "-", "+" : "+"}
-  
-  ind = CI_new[(CI_new["gene_strandR1B_new"].isna()) & (CI_new["gene_strandR1A_new"] == CI_new["read_strandR1A"])].index
-  CI_new.loc[ind,"gene_strandR1B_new"] = CI_new.loc[ind]["read_strandR1B"].map(same)
-  
-  ind = CI_new[(CI_new["gene_strandR1B_new"].isna()) & (CI_new["gene_strandR1A_new"] != CI_new["read_strandR1A"]) & (~CI_new["gene_strandR1A_new"].isna())].index
-  CI_new.loc[ind,"gene_strandR1B_new"] = CI_new.loc[ind]["read_strandR1B"].map(reverse)
-  
-  ind = CI_new[(CI_new["gene_strandR1A_new"].isna()) & (CI_new["gene_strandR1B_new"] == CI_new["read_strandR1B"])].index
-  CI_new.loc[ind,"gene_strandR1A_new"] = CI_new.loc[ind]["read_strandR1A"].map(same)
-  
-  ind = CI_new[(CI_new["gene_strandR1A_new"].isna()) & (CI_new["gene_strandR1B_new"] != CI_new["read_strandR1B"]) & (~CI_new["gene_strandR1B_new"].isna())].index
-  CI_new.loc[ind,"gene_strandR1A_new"] = CI_new.loc[ind]["read_strandR1A"].map(reverse)
-  CI_new["refName_newR1"] = ""
-  CI_new["geneR1B_uniq"].fillna("",inplace=True)
-  CI_new["geneR1A_uniq"].fillna("",inplace=True)
-  
-  CI_new["reverse"] = False
-  ind = CI_new[(CI_new["fileTypeR1"] == "Aligned") & (CI_new["gene_strandR1A_new"] == "-") & (CI_new["juncPosR1A"] < CI_new["juncPosR1B"])].index
-  CI_new.loc[ind,"refName_newR1"] = CI_new.loc[ind]["chrR1B"] + ":" + CI_new.loc[ind]["geneR1B_uniq"].astype(str) + ":" + CI_new.loc[ind]["juncPosR1B"].astype(str) + ":" + CI_new.loc[ind]["gene_strandR1B_new"] + "|" + CI_new.loc[ind]["chrR1A"] + ":" + CI_new.loc[ind]["geneR1A_uniq"].astype(str) + ":" + CI_new.loc[ind]["juncPosR1A"].astype(str) + ":" + CI_new.loc[ind]["gene_strandR1A_new"]
-  CI_new.loc[ind,"reverse"] = True
-  name_swap = {}
-  for c in CI_new.columns:
-    if "R1A" in c:
-      name_swap[c] = c.replace("R1A","R1B")
-      name_swap[c.replace("R1A","R1B")] = c
-  
-#  CI_new = pickle.load(open("/scratch/PI/horence/JuliaO/single_cell/STAR_wrapper/output/test/CI_new.pkl","rb"))
-
-  if swap_names:
-    CI_new.loc[ind] = CI_new.loc[ind].rename(columns=name_swap)
-  ind = CI_new[(CI_new["fileTypeR1"] == "Aligned") & (CI_new["gene_strandR1A_new"] == "+")].index
-  
-  CI_new.loc[ind,"refName_newR1"] = CI_new.loc[ind]["chrR1A"] + ":" + CI_new.loc[ind]["geneR1A_uniq"] + ":" + CI_new.loc[ind]["juncPosR1A"].astype(str) + ":" + CI_new.loc[ind]["gene_strandR1A_new"] + "|" +  CI_new.loc[ind]["chrR1B"] + ":" + CI_new.loc[ind]["geneR1B_uniq"] + ":" + CI_new.loc[ind]["juncPosR1B"].astype(str) + ":" + CI_new.loc[ind]["gene_strandR1B_new"]
-  
-  
-  ind = CI_new[(CI_new["fileTypeR1"] == "Chimeric") & (CI_new["gene_strandR1A_new"] != CI_new["read_strandR1A"]) & (CI_new["gene_strandR1B_new"] != CI_new["read_strandR1B"])].index
-  
-  
-  CI_new.loc[ind,"refName_newR1"] = CI_new.loc[ind]["chrR1B"] + ":" + CI_new.loc[ind]["geneR1B_uniq"] + ":" + CI_new.loc[ind]["juncPosR1B"].astype(str) + ":" + CI_new.loc[ind]["gene_strandR1B_new"] + "|" + CI_new.loc[ind]["chrR1A"] + ":" + CI_new.loc[ind]["geneR1A_uniq"] + ":" + CI_new.loc[ind]["juncPosR1A"].astype(str) + ":" + CI_new.loc[ind]["gene_strandR1A_new"]
-  CI_new.loc[ind,"reverse"] = True
-  if swap_names:
-    CI_new.loc[ind] = CI_new.loc[ind].rename(columns=name_swap)
-  
-  ind = CI_new[(CI_new["fileTypeR1"] == "Chimeric") & ((CI_new["gene_strandR1A_new"] == CI_new["read_strandR1A"]) | (CI_new["gene_strandR1B_new"] == CI_new["read_strandR1B"]))].index
-  CI_new.loc[ind,"refName_newR1"] = CI_new.loc[ind]["chrR1A"] + ":" + CI_new.loc[ind]["geneR1A_uniq"].astype(str) + ":" + CI_new.loc[ind]["juncPosR1A"].astype(str) + ":" + CI_new.loc[ind]["gene_strandR1A_new"] + "|" +  CI_new.loc[ind]["chrR1B"] + ":" + CI_new.loc[ind]["geneR1B_uniq"].astype(str) + ":" + CI_new.loc[ind]["juncPosR1B"].astype(str) + ":" + CI_new.loc[ind]["gene_strandR1B_new"]
- 
-  ind1 = CI_new[(CI_new["refName_newR1"] == "") | (CI_new["refName_newR1"].isna())].index # this ind1 is used to simply replace refName_newR1 with the refName_ABR1 
-
-## adding the junction type to refName_newR1
-  CI_new["junc_type"] = ""
-  ind = CI_new[(CI_new["chrR1A"] != CI_new["chrR1B"]) | ((CI_new["gene_strandR1A_new"] == CI_new["gene_strandR1B_new"]) & (abs(CI_new["juncPosR1A"] - CI_new["juncPosR1B"])>=1000000) )].index 
-  CI_new.loc[ind,"refName_newR1"] = CI_new.loc[ind]["refName_newR1"] + "|fus"
-  CI_new.loc[ind,"junc_type"] = "fus"
-
-  ind = CI_new[(CI_new["chrR1A"] == CI_new["chrR1B"]) & (CI_new["gene_strandR1A_new"] != CI_new["gene_strandR1B_new"])].index
-  CI_new.loc[ind,"refName_newR1"] = CI_new.loc[ind]["refName_newR1"] + "|sc"
-  CI_new.loc[ind,"junc_type"] = "sc"
-
-  ind = CI_new[(CI_new["junc_type"] != "sc") & (CI_new["junc_type"] != "fus") &  ( ((CI_new["gene_strandR1A_new"] == "+") & (CI_new["juncPosR1A"] > CI_new["juncPosR1B"])) | ((CI_new["gene_strandR1A_new"] == "-") & (CI_new["juncPosR1A"] < CI_new["juncPosR1B"])) )].index
-  CI_new.loc[ind,"refName_newR1"] = CI_new.loc[ind]["refName_newR1"] + "|rev"
-  CI_new.loc[ind,"junc_type"] = "rev"
-
-  ind = CI_new[(CI_new["junc_type"] != "sc") & (CI_new["junc_type"] != "fus") & (CI_new["junc_type"] != "rev")].index
-  CI_new.loc[ind,"refName_newR1"] = CI_new.loc[ind]["refName_newR1"] + "|lin"
-
-  CI_new = CI_new.drop("junc_type", axis=1)
-
-  CI_new.loc[ind1,"refName_newR1"] = CI_new.loc[ind1]["refName_ABR1"]
-  ref_dict = pd.Series(CI_new.refName_newR1.values,index=CI_new.refName_ABR1).to_dict()
-  rev_dict = pd.Series(CI_new.reverse.values,index=CI_new.refName_ABR1).to_dict()
-  CI["refName_newR1"] = CI["refName_ABR1"].map(ref_dict)
-  CI["reverse"] = CI["refName_ABR1"].map(rev_dict)
-  ind = CI["reverse"].index
-  name_swap = {}
-
-  for c in CI.columns:
-    if str(CI[c].dtype)[0] == "i":
-#      CI[c] = CI[c].astype("I" + str(CI[c].dtype)[1:])
-      CI[c] = CI[c].astype("float32")
-
-
-    if "R1A" in c:
-      name_swap[c] = c.replace("R1A","R1B")
-      name_swap[c.replace("R1A","R1B")] = c
-
-
-  if swap_names:
-    CI.loc[ind] = CI.loc[ind].rename(columns=name_swap)
-  CI_new = CI
-
-  CI_new["gene_strandR1A"] = CI_new["refName_newR1"].str.split("|").str[0].str.split(":").str[-1]
-  CI_new["gene_strandR1B"] = CI_new["refName_newR1"].str.split("|").str[1].str.split(":").str[-1]
-  CI_new["juncPosR1A"] = CI_new["refName_newR1"].str.split("|").str[0].str.split(":").str[2].astype("int")
-  CI_new["juncPosR1B"] = CI_new["refName_newR1"].str.split("|").str[1].str.split(":").str[2].astype("int")
-  CI_new["chrR1A"] = CI_new["refName_newR1"].str.split("|").str[0].str.split(":").str[0]
-  CI_new["chrR1B"] = CI_new["refName_newR1"].str.split("|").str[1].str.split(":").str[0]
-  CI_new["geneR1A_uniq"] = CI_new["refName_newR1"].str.split("|").str[0].str.split(":").str[1]
-  CI_new["geneR1B_uniq"] = CI_new["refName_newR1"].str.split("|").str[1].str.split(":").str[1]
-  CI_new.drop("reverse",axis=1,inplace=True)
-  return CI_new
-
+  for half, other in [("B","A"),("A","B")]:
+    ind = new_strand[half].isna() & (new_strand[other] == read_strands[other])
+    new_strand[half][ind] = read_strands[half][ind].map(same)
+    ind = new_strand[half].isna() & (new_strand[other] != read_strands[other]) & new_strand[other].notna()
+    new_strand[half][ind] = read_strands[half][ind].map(reverse)
+
+  # sides in gene strand order: B first where the junction is named backward
+  backward = (aligned & (new_strand["A"] == "-") & (pos["A"] < pos["B"])) | (chimeric & (new_strand["A"] != read_strands["A"]) & (new_strand["B"] != read_strands["B"]))
+  forward = (aligned & (new_strand["A"] == "+")) | (chimeric & ((new_strand["A"] == read_strands["A"]) | (new_strand["B"] == read_strands["B"])))
+  named = backward | forward
+  for half in "AB":
+    named &= chrs[half].notna() & uniq[half].notna() & new_strand[half].notna()
+
+  fus = (chrs["A"] != chrs["B"]) | ((new_strand["A"] == new_strand["B"]) & (abs(pos["A"] - pos["B"]) >= 1000000))
+  sc = (chrs["A"] == chrs["B"]) & (new_strand["A"] != new_strand["B"])
+  rev = ((new_strand["A"] == "+") & (pos["A"] > pos["B"])) | ((new_strand["A"] == "-") & (pos["A"] < pos["B"]))
+  junc_type = np.select([fus, sc, rev], ["fus", "sc", "rev"], "lin")
+
+  new_sides = {"gene_strandR1" : new_strand, "juncPosR1" : pos, "chrR1" : chrs, "geneR1{}_uniq" : uniq}
+  annotated_sides = {"gene_strandR1" : gene_strand, "juncPosR1" : pos, "chrR1" : chrs, "geneR1{}_uniq" : {half : J["geneR1" + half] for half in "AB"}}
+  renamed = {}
+  for column, values in new_sides.items():
+    for half, other in [("A","B"),("B","A")]:
+      name = column.format(half) if "{}" in column else column + half
+      renamed[name] = values[half].where(~backward, values[other]).where(named, annotated_sides[column][half])
+  renamed["junc_typeR1"] = pd.Categorical(np.where(named, junc_type, J["juncTypeR1"]), categories=junc_types)
+  renamed = pd.DataFrame(renamed)
+  renamed.insert(0, "refName_newR1", junction_name(renamed))
+  renamed["junction_id"] = junction_ids(renamed["refName_newR1"])
+  return renamed
+
+def junction_ids(refnames):
+  """64-bit id of each refName_newR1, the same for a junction in every sample and run"""
+  return np.array([int.from_bytes(hashlib.blake2b(x.encode(), digest_size=8).digest(), "little", signed=True) for x in refnames], dtype=np.int64)
+
+def junction_name(df):
+  """refName_newR1 of each row, put back together from the structured junction columns"""
+  side = {half : df["chrR1" + half].astype(str) + ":" + df["geneR1{}_uniq".format(half)].astype(str) + ":" + df["juncPosR1" + half].astype(np.int64).astype(str) + ":" + df["gene_strandR1" + half].astype(str) for half in "AB"}
+  return side["A"] + "|" + side["B"] + "|" + df["junc_typeR1"].astype(str)
+
+class JunctionNames:
+  """rename_junctions of every junction renamed so far, by refName_ABR1
+
+  The tables of each add are kept as parts, and a part is only concatenated onto the one before it
+  once it's as large, so adding a chunk's junctions costs about the size of the chunk rather than
+  of every junction so far.
+  """
+  def __init__(self):
+    self.row_of = {}
+    self.parts = []
+    self.starts = []
+    self.size = 0
+    self.empty = pd.DataFrame({c : pd.Series(dtype=np.int64 if c.startswith("juncPos") else object) for c in ["refName_newR1","gene_strandR1A","gene_strandR1B","juncPosR1A","juncPosR1B","chrR1A","chrR1B","geneR1A_uniq","geneR1B_uniq"]})
+    self.empty["junc_typeR1"] = pd.Categorical([], categories=junc_types)
+    self.empty["junction_id"] = pd.Series(dtype=np.int64)
+
+  def rows(self, refnames):
+    """Row of each of refnames, -1 for the ones not renamed yet"""
+    return np.array([self.row_of.get(refname, -1) for refname in refnames], dtype=np.int64)
+
+  def add(self, refnames, table):
+    self.row_of.update(zip(refnames, range(self.size, self.size + len(table))))
+    self.parts.append(table.reset_index(drop=True))
+    self.starts.append(self.size)
+    self.size += len(table)
+    while len(self.parts) > 1 and len(self.parts[-1]) >= len(self.parts[-2]):
+      last = self.parts.pop()
+      self.starts.pop()
+      self.parts[-1] = pd.concat([self.parts[-1], last], ignore_index=True)
+
+  def take(self, rows):
+    """The renamed junctions at rows, in that order"""
+    if len(rows) == 0:
+      return self.empty
+    part_of = np.searchsorted(self.starts, rows, side="right") - 1
+    pieces = []
+    order = []
+    for part in np.unique(part_of):
+      ind = np.flatnonzero(part_of == part)
+      pieces.append(self.parts[part].take(rows[ind] - self.starts[part]))
+      order.append(ind)
+    taken = pd.concat(pieces, ignore_index=True)
+    return taken.take(np.argsort(np.concatenate(order), kind="stable")).reset_index(drop=True)
+
+def modify_refnames(CI, assembly, known_refnames = None, ann = None):
+  """Rename every junction from the first read seen with it
+
+  Each junction is renamed once by rename_junctions and the names are joined back to the reads by
+  junction code. known_refnames is a JunctionNames that carries the junctions renamed in earlier
+  chunks of the same bam; it is updated with the new ones. Gene strands come from the annotator
+  when it was built with them.
+  """
+  if known_refnames is None:
+    known_refnames = JunctionNames()
+  CI["HIR1B"] = CI["HIR1A"]
+  # a read without a refName_ABR1 gets code -1 and no junction
+  codes, refnames = pd.factorize(CI["refName_ABR1"], use_na_sentinel=True)
+  rows = known_refnames.rows(refnames)
+  new = np.flatnonzero(rows == -1)
+  if len(new) > 0:
+    uniques, first = np.unique(codes, return_index=True)
+    first = first[uniques >= 0]
+    known_refnames.add(refnames[new], rename_junctions(CI.iloc[first[new]].reset_index(drop=True), gene_strands(assembly, ann)))
+    rows = known_refnames.rows(refnames)
+  junctions = known_refnames.take(rows)
+
+  # the renamed columns are missing for those reads, so integer ones become nullable to hold that
+  missing = bool((codes == -1).any())
+  for c in junctions.columns:
+    values = junctions[c].array
+    if missing and values.dtype.kind in "iu":
+      values = pd.array(values, dtype="Int64")
+    CI[c] = values.take(codes, allow_fill=missing)
+  return CI.drop(columns=annotation_columns("R1"))
+
+
+# BGZF member header: gzip magic with FEXTRA set, XLEN 6 and the "BC" subfield holding the block size
+bgzf_magic = b"\x1f\x8b\x08\x04"
+bam_record_fields = struct.Struct("<iiiBBHHHiiii")
+
+def next_bgzf_block(raw, offset):
+  """File offset of the first BGZF block starting at or after offset, or None if there is none"""
+  raw.seek(offset)
+  # blocks are at most 64 KiB, so the next one starts in here unless the file ends first
+  data = raw.read(2 ** 17 + 18)
+  i = data.find(bgzf_magic)
+  while 0 <= i and i + 18 <= len(data):
+    if data[i + 10:i + 16] == b"\x06\x00BC\x02\x00":
+      return offset + i
+    i = data.find(bgzf_magic, i + 1)
+  return None
+
+def read_bgzf_blocks(raw, offset, n):
+  """Decompressed contents of up to n BGZF blocks from offset, and the size of the first one"""
+  data = []
+  for k in range(n):
+    raw.seek(offset)
+    header = raw.read(18)
+    if len(header) < 18:
+      break
+    bsize = struct.unpack_from("<H", header, 16)[0] + 1
+    data.append(zlib.decompress(raw.read(bsize - 18)[:-8], -15))
+    offset += bsize
+  if not data:
+    return b"", 0
+  return b"".join(data), len(data[0])
+
+def is_bam_record(data, p, n_refs):
+  """Whether a plausible BAM alignment record starts at byte p of decompressed BAM data"""
+  if p + bam_record_fields.size > len(data):
+    return False
+  block_size, ref_id, pos, l_read_name, mapq, bin_, n_cigar_op, flag, l_seq, next_ref_id, next_pos, tlen = bam_record_fields.unpack_from(data, p)
+  if not (-1 <= ref_id < n_refs and -1 <= next_ref_id < n_refs and pos >= -1 and next_pos >= -1 and l_read_name >= 2 and l_seq >= 0):
+    return False
+  if 32 + l_read_name + 4 * n_cigar_op + (l_seq + 1) // 2 + l_seq > block_size:
+    return False
+  name_end = p + 36 + l_read_name - 1
+  if name_end >= len(data) or data[name_end] != 0:
+    return False
+  return all(33 <= c <= 126 for c in data[p + 36:name_end])
+
+def bam_record_after(bam_file, offset, n_refs, chain = 3):
+  """Virtual offset of a BAM record starting in the first BGZF block at or after byte offset
+
+  Blocks don't start on record boundaries, so the record is found by checking that chain records
+  in a row parse as plausible records from that byte on.
+  """
+  with open(bam_file, "rb") as raw:
+    block = next_bgzf_block(raw, offset)
+    while block is not None:
+      data, first_size = read_bgzf_blocks(raw, block, 4)
+      if first_size == 0:
+        return None
+      for p in range(first_size):
+        q = p
+        for k in range(chain):
+          if q >= len(data) or not is_bam_record(data, q, n_refs):
+            break
+          q += 4 + struct.unpack_from("<i", data, q)[0]
+        else:
+          return (block << 16) | p
+      block = next_bgzf_block(raw, block + 1)
+  return None
+
+def bam_read_name_ranges(bam_file, n):
+  """Split a bam grouped by read name into about n (start, end) virtual offset ranges
+
+  The file is cut at evenly spaced BGZF blocks, and every cut is moved on to the next record with
+  a different read name, so all the records of a read (both halves of a chimeric alignment,
+  every multimapper) are in the same range. The last range has end None.
+  """
+  alignFile = pysam.AlignmentFile(bam_file)
+  first = alignFile.tell()
+  n_refs = alignFile.nreferences
+  size = os.path.getsize(bam_file)
+  cuts = [first]
+  for k in range(1, n):
+    start = bam_record_after(bam_file, max(k * size // n, first >> 16), n_refs)
+    if start is None or start <= cuts[-1]:
+      continue
+    alignFile.seek(start)
+    name = None
+    cut = None
+    while True:
+      offset = alignFile.tell()
+      try:
+        bam_read = next(alignFile)
+      except StopIteration:
+        break
+      if name is not None and bam_read.query_name != name:
+        cut = offset
+        break
+      name = bam_read.query_name
+    if cut is not None and cut > cuts[-1]:
+      cuts.append(cut)
+  return list(zip(cuts, cuts[1:] + [None]))
+
+def bam_range(alignFile, start, end):
+  """Records of a bam from virtual offset start up to (not including) end"""
+  alignFile.seek(start)
+  while end is None or alignFile.tell() < end:
+    try:
+      yield next(alignFile)
+    except StopIteration:
+      return
+
+# how the class input parquet files are written
+parquet_options = {"compression" : "zstd", "use_dictionary" : True}
+
+# types of the class input columns, by name without their R1/R2 and A/B. Repetitive strings are
+# categorical (dictionaries in parquet) and integers the narrowest nullable type that holds them:
+# STAR reads are at most 650 bases, so counts along a read fit in 16 bits, and bam positions in 32
+class_input_schema = {"fileType" : "category", "chr" : "category", "read_strand" : "category", "gene_strand" : "category",
+                      "gene" : "category", "gene_uniq" : "category", "refName_AB" : "category", "refName_new" : "category",
+                      "junc_type" : "category", "cigar" : "category", "barcode" : "category",
+                      "maxA_10mer" : "Int8", "maxT_10mer" : "Int8", "maxG_10mer" : "Int8", "maxC_10mer" : "Int8", "primary" : "Int8",
+                      "genomicAlignment" : "Int8", "read_strand_compatible" : "Int8", "location_compatible" : "Int8", "primary_bam" : "Int8",
+                      "readLen" : "Int16", "AT_run_" : "Int16", "GC_run_" : "Int16", "max_run_" : "Int16", "aScore" : "Int16", "M" : "Int16",
+                      "S" : "Int16", "nmm" : "Int16", "qual" : "Int16", "NH" : "Int16", "HI" : "Int16", "flag" : "Int16",
+                      "genomic_aScore" : "Int16", "max_id_priority" : "Int16",
+                      "juncPos" : "Int32", "spliceDist" : "Int32"}
+
+def class_input_dtypes(columns):
+  """class_input_schema type of each of columns it has one for"""
+  dtypes = {}
+  for c in columns:
+    base = re.sub("R[12][AB]?(?=(_uniq)?$)", "", c)
+    if base in class_input_schema:
+      dtypes[c] = class_input_schema[base]
+  return dtypes
+
+def apply_class_input_schema(df):
+  """df with the class_input_schema types, the categories always strings even in a column that's all NaN
+
+  Values that don't fit their integer type raise rather than wrap.
+  """
+  dtypes = class_input_dtypes(df.columns)
+  for c, dtype in dtypes.items():
+    if dtype == "category" and not isinstance(df[c].dtype, pd.CategoricalDtype):
+      dtypes[c] = pd.CategoricalDtype(pd.Index(df[c].dropna().unique(), dtype=object).sort_values())
+  return df.astype(dtypes)
+
+def tsv_file(prefix, tsv):
+  """Path of the tsv copy of an output for the --tsv choice, or None if there isn't one"""
+  return {"plain" : prefix + ".tsv", "gz" : prefix + ".tsv.gz", "none" : None}[tsv]
+
+# frame write_tsv is writing, for the pool workers it forks to read
+def tsv_batch(batch):
+  rows, header, compress = batch
+  text = rows.to_csv(sep="\t", index=False, header=header).encode()
+  if compress:
+    return gzip.compress(text, compresslevel=6)
+  return text
+
+def write_tsv(df, out, header = True, compress = False, processes = 1, batch_rows = 100000):
+  """Write df to the binary file out as df.to_csv(sep="\t", index=False) would, a batch of rows at a time
+
+  The batches are formatted, and gzipped as members of one gzip file if compress, over a process pool
+  when there is more than one process. Each worker is sent its rows, so this works whatever the start method.
+  """
+  starts = range(0, max(len(df), 1), batch_rows)
+  batches = ((df.iloc[start:start + batch_rows], header and start == 0, compress) for start in starts)
+  if processes > 1 and len(starts) > 1:
+    with Pool(processes) as pool:
+      for text in pool.imap(tsv_batch, batches):
+        out.write(text)
+  else:
+    for batch in batches:
+      out.write(tsv_batch(batch))
+
+def write_output(df, pq_path, tsv_path = None, processes = 1):
+  """Write a finished class input table to parquet and, if tsv_path is given, as a tsv (gzipped if it ends in .gz)"""
+  df = apply_class_input_schema(df)
+  df.to_parquet(pq_path, **parquet_options)
+  if tsv_path is not None:
+    with open(tsv_path, "wb") as out:
+      write_tsv(df, out, compress=tsv_path.endswith(".gz"), processes=processes)
+
+class ChunkWriter:
+  """Collects data frames with the same columns into one parquet file (and optionally a tsv, gzipped if it ends in .gz)
+
+  Every chunk is spilled to its own part file as it comes in, and close() copies the parts into the
+  output one row group at a time. A column can be all NaN floats in one chunk and strings in the
+  next, so the parts are cast to the dtypes pd.concat would have given the whole output, which
+  makes the files the same as writing the concatenated frame at once. Every chunk gets the
+  class_input_schema, and the categoricals are written with int32 indices so the row groups share
+  a schema whatever their categories.
+  """
+  def __init__(self, pq_path, tsv_path = None, processes = 1):
+    self.pq_path = pq_path
+    self.tsv_path = tsv_path
+    self.processes = processes
+    self.parts_dir = tempfile.mkdtemp(prefix=os.path.basename(pq_path) + ".parts", dir=os.path.dirname(os.path.abspath(pq_path)))
+    self.parts = []
+    self.empty = None
+    self.object_types = {}
+
+  def write(self, df):
+    if self.empty is not None:
+      df = df[list(self.empty.columns)]
+    df = apply_class_input_schema(df.reset_index(drop=True))
+
+    # zero-row frame carrying the dtypes of every chunk so far through pd.concat
+    if self.empty is None:
+      self.empty = df.iloc[:0]
+    else:
+      self.empty = pd.concat([self.empty, df.iloc[:0]])
+    table = pyarrow.Table.from_pandas(df, preserve_index=False)
+    for field in table.schema:
+      if df[field.name].dtype == object and (field.name not in self.object_types or pyarrow.types.is_null(self.object_types[field.name])):
+        self.object_types[field.name] = field.type
+    self.parts.append(os.path.join(self.parts_dir, "{}.pq".format(len(self.parts))))
+    pyarrow.parquet.write_table(table, self.parts[-1])
+
+  def close(self):
+    if self.empty is not None:
+      # categoricals with different categories concat to object
+      categorical = [c for c, dtype in class_input_dtypes(self.empty.columns).items() if dtype == "category"]
+      dtypes = self.empty.dtypes.to_dict()
+      fields = []
+      for field in pyarrow.Schema.from_pandas(self.empty, preserve_index=False):
+        if field.name in categorical:
+          dtypes[field.name] = "category"
+          field = field.with_type(pyarrow.dictionary(pyarrow.int32(), pyarrow.string()))
+        elif self.empty[field.name].dtype == object:
+          field = field.with_type(self.object_types[field.name])
+        fields.append(field)
+      schema = pyarrow.schema(fields)
+      writer = None
+      tsv = None
+      if self.tsv_path is not None:
+        tsv = open(self.tsv_path, "wb")
+      for i, part in enumerate(self.parts):
+        df = pyarrow.parquet.read_table(part).to_pandas().astype(dtypes)
+        table = pyarrow.Table.from_pandas(df, schema=schema, preserve_index=False)
+        if writer is None:
+          writer = pyarrow.parquet.ParquetWriter(self.pq_path, table.schema, **parquet_options)
+        if table.num_rows > 0 or i == len(self.parts) - 1:
+          writer.write_table(table)
+        if tsv is not None:
+          write_tsv(df, tsv, header=(i == 0), compress=self.tsv_path.endswith(".gz"), processes=self.processes)
+      writer.close()
+      if tsv is not None:
+        tsv.close()
+    shutil.rmtree(self.parts_dir)
 
 def get_loc_flag(row):
   if "|fus" in row["refName_ABR1"]:
@@ -235,17 +488,89 @@ def get_loc_flag(row):
       return 0
   return "error"
 
+def loc_flags(CI):
+  """get_loc_flag of every row of a paired class input at once, as nullable Int64 with NA in place of "error"
+
+  The junction type is the last field of refName_ABR1, split once per junction.
+  """
+  codes, refNames = pd.factorize(CI["refName_ABR1"], use_na_sentinel=False)
+  junc_type = pd.Series(refNames, dtype=object).str.rsplit("|", n=1).str[-1].to_numpy()[codes]
+  posR1A = CI["juncPosR1A"].to_numpy(dtype=np.float64)
+  posR1B = CI["juncPosR1B"].to_numpy(dtype=np.float64)
+  posR2A = CI["juncPosR2A"].to_numpy(dtype=np.float64)
+  strand = CI["read_strandR1A"].to_numpy()
+  lin = junc_type == "lin"
+  flags = np.select([junc_type == "fus", junc_type == "sc", np.isnan(posR2A), lin & (strand == "+"), lin & (strand == "-"), junc_type == "rev"],
+                    [1, 0, 0, posR2A >= posR1A, posR2A <= posR1A, ((posR1A <= posR2A) & (posR2A <= posR1B)) | ((posR1B <= posR2A) & (posR2A <= posR1A))], -1)
+  return pd.arrays.IntegerArray(flags.astype(np.int64), flags == -1)
+
+# cigartuples op codes are indexes into this
+cigar_chars = "MIDNSHP=XB"
+cigar_re = re.compile(r'(\d+)([A-Z]{1})')
+
+def cigar_tuples(cigar):
+  """cigartuples of a cigar string, for callers that only have the string"""
+  return [(cigar_chars.index(op), int(length)) for length, op in cigar_re.findall(cigar)]
+
+def cigar_string(cigar):
+  return "".join([str(length) + cigar_chars[op] for op, length in cigar])
+
+def scan_cigar(cigar):
+  """One pass over cigartuples: the index of the largest N (None without one) and its length, the
+  bases of each op before it and in all, and the N and D bases between it and the next M
+  """
+  split = None
+  max_N = 0
+  before = None
+  gap = 0
+  in_gap = False
+  totals = [0] * len(cigar_chars)
+  for i, (op, length) in enumerate(cigar):
+    if op == 3 and length > max_N:
+      split = i
+      max_N = length
+      before = totals[:]
+      gap = 0
+      in_gap = True
+    elif in_gap:
+      if op == 0:
+        in_gap = False
+      elif op == 2 or op == 3:
+        gap += length
+    totals[op] += length
+  return split, max_N, before, totals, gap
+
+def align_cigar(cigar, position, fill_char = np.nan):
+  """split_cigar_align, get_SM of both halves and readObj_junction of an aligned read's cigartuples
+
+  Returns the two halves, their (M, S, I, D) and the last base before and first base after the
+  largest N, or the whole cigar and position when there's no N.
+  """
+  split, max_N, before, totals, gap = scan_cigar(cigar)
+  if split is None:
+    return cigar_string(cigar), fill_char, (totals[0], totals[4], totals[1], totals[2]), (fill_char,) * 4, position, fill_char
+  after = [t - b for t, b in zip(totals, before)]
+  offset1 = position + before[0] + before[3] + before[2]
+  return (cigar_string(cigar[:split]), cigar_string(cigar[split + 1:]), (before[0], before[4], before[1], before[2]),
+          (after[0], after[4], after[1], after[2]), offset1 - 1, offset1 + max_N + gap)
+
+def chim_cigar(cigar):
+  """split_cigar_chim, get_SM of the result and parse_cigar of one segment of a chimeric read's cigartuples
+
+  The soft clip covering the other segment is dropped: the only one, or the longer of two.
+  """
+  first, last = cigar[0], cigar[-1]
+  if first[0] == 4 and (last[0] != 4 or first[1] > last[1]):
+    kept = cigar[1:]
+  else:
+    assert last[0] == 4
+    kept = cigar[:-1]
+  totals = scan_cigar(kept)[3]
+  return cigar_string(kept), (totals[0], totals[4], totals[1], totals[2]), totals[0] + totals[3] + totals[2]
+
 def parse_cigar(cigar):
-  matches = re.findall(r'(\d+)([A-Z]{1})', cigar)
-  val = 0
-  for m in matches:
-    if m[1] == "M":
-      val += int(m[0])
-    elif m[1] == "N":
-      val += int(m[0])
-    elif m[1] == "D":
-      val += int(m[0])
-  return val
+  totals = scan_cigar(cigar_tuples(cigar))[3]
+  return totals[0] + totals[3] + totals[2]
 
 def read_strand(flag, fill_char = np.nan):
   if flag == fill_char:
@@ -253,7 +578,7 @@ def read_strand(flag, fill_char = np.nan):
   sign_dict = {"0" : "+", "1" : "-"}
   return sign_dict['{0:012b}'.format(flag)[7]]
 
-def chim_refName(flags, cigars, offsets, rnames, ann):
+def chim_junction(flags, ref_lens, offsets, rnames):
     sign_dict = {"0" : "+", "1" : "-"}
     signs = []
     for i in range(len(flags)):
@@ -263,8 +588,7 @@ def chim_refName(flags, cigars, offsets, rnames, ann):
 
     # determined by comparing Chimeric.out.junction and Chimeric.out.sam
     if signs[0] == "+":
-      cig_val = parse_cigar(cigars[0])
-      posFirst = int(offsets[0]) + cig_val - 1
+      posFirst = int(offsets[0]) + ref_lens[0] - 1
     elif signs[0] == "-":
       posFirst = int(offsets[0])
     else:
@@ -273,13 +597,7 @@ def chim_refName(flags, cigars, offsets, rnames, ann):
     if signs[1] == "+":
       posSecond = int(offsets[1])
     elif signs[1] == "-":
-      cig_val = parse_cigar(cigars[1])
-      posSecond = int(offsets[1]) + cig_val - 1
-
-
-
-    gene1, strand1 =  ann.get_name_given_locus(rnames[0], posFirst)
-    gene2, strand2 =  ann.get_name_given_locus(rnames[1], posSecond)
+      posSecond = int(offsets[1]) + ref_lens[1] - 1
 
     if rnames[0] != rnames[1]:
         juncType = "fus"
@@ -291,6 +609,14 @@ def chim_refName(flags, cigars, offsets, rnames, ann):
          juncType = "lin"
     else:
         juncType = "err"
+    return int(posFirst), int(posSecond), juncType
+
+def chim_refName(flags, cigars, offsets, rnames, ann):
+    posFirst, posSecond, juncType = chim_junction(flags, [parse_cigar(cigar) for cigar in cigars], offsets, rnames)
+
+    gene1, strand1 =  ann.get_name_given_locus(rnames[0], posFirst)
+    gene2, strand2 =  ann.get_name_given_locus(rnames[1], posSecond)
+
 #    return "{}:{}:{}:{}|{}:{}:{}:{}|{}".format(rnames[0], "", posFirst, signs[0], rnames[1], "", posSecond, signs[1], juncType)
     unchanged = "{}:{}:{}:{}|{}:{}:{}:{}|{}".format(rnames[0], gene1, posFirst, strand1, rnames[1], gene2, posSecond, strand2, juncType)
 
@@ -306,6 +632,11 @@ def chim_refName(flags, cigars, offsets, rnames, ann):
 #     elif signs[0] == "-":
 #       return unchanged, "{}:{}:{}:{}|{}:{}:{}:{}|{}".format(rnames[1], gene2, posSecond, strand2, rnames[0], gene1, posFirst, strand1, juncType)
 
+def readObj_junction(cigar, position, fill_char = np.nan):
+  if "N" not in cigar:
+    return position, fill_char
+  return align_cigar(cigar_tuples(cigar), position, fill_char)[4:]
+
 def readObj_refname(flag, cigar, seqname, position, ann, fill_char):
   flag_dict = {0 : "+", 256 : "+", 16 : "-", 272 : "-"}
   read_strand = flag_dict[flag]
@@ -314,35 +645,7 @@ def readObj_refname(flag, cigar, seqname, position, ann, fill_char):
     gene, strand = ann.get_name_given_locus(seqname, int(position))
     return "{}:{}:{}".format(seqname,gene,strand), seqname,gene, position, fill_char, fill_char, fill_char
 
-  matches = re.findall(r'(\d+)([A-Z]{1})', cigar)
-
-  # find the largest N (the one to split on)
-  max_N_ind = None
-  max_N_val = 0
-  for i in range(len(matches)):
-      m = matches[i]
-      if m[1] == "N":
-          if int(m[0]) > max_N_val:
-              max_N_ind = i
-              max_N_val = int(m[0])
-
-  # get the first base of the junction
-  offset1 = position
-  for i in range(max_N_ind):
-      m = matches[i]
-      if m[1] in ["M","N","D"]:
-          offset1 += int(m[0])
-
-  # get the second base of the junction
-  offset2 = offset1 + max_N_val
-  for i in range(max_N_ind + 1, len(matches) + 1):
-      m = matches[i]
-      if m[1] == "M":
-          break
-
-      elif m[1] in ["N","D"]:
-          offset2 += int(m[0])
-  offset1 -= 1
+  offset1, offset2 = readObj_junction(cigar, position, fill_char)
   gene1, strand1 = ann.get_name_given_locus(seqname, offset1)
   gene2, strand2 = ann.get_name_given_locus(seqname, offset2)
 
@@ -354,25 +657,42 @@ def readObj_refname(flag, cigar, seqname, position, ann, fill_char):
 #   else:
 #     return  "{}:{}:{}:{}|{}:{}:{}:{}|{}".format(seqname, gene1, offset1, strand1,seqname, gene2, offset2, strand2, read_class), "{}:{}:{}:{}|{}:{}:{}:{}|{}".format(seqname, gene2, offset2, strand2,seqname, gene1, offset1, strand1, read_class)
 
+def annotation_columns(suffix):
+  """Columns annotate_junctions keeps next to refName_AB for renaming the junctions, which aren't written out"""
+  return ["juncType" + suffix, "gene_strand_AB{}A".format(suffix), "gene_strand_AB{}B".format(suffix)]
+
+def annotate_junctions(CI_dict, ann, suffix, fill_char = np.nan):
+  """Fill in the genes and refName of a chunk of reads from their junction positions with one annotator call per side
+
+  The gene strand of each side and the junction type are kept as annotation_columns.
+  """
+  sides = []
+  for half in ["A","B"]:
+    chrs = pd.Series(CI_dict["chr{}{}".format(suffix,half)], dtype=object)
+    pos = pd.Series(CI_dict["juncPos{}{}".format(suffix,half)], index=chrs.index, dtype="float64").astype("Int64")
+    genes = pd.Series(fill_char, index=chrs.index, dtype=object)
+    strands = pd.Series(fill_char, index=chrs.index, dtype=object)
+    has_pos = chrs.notna()
+    genes[has_pos], strands[has_pos] = ann.annotate_many(chrs[has_pos], pos[has_pos].astype("int64"))
+    CI_dict["gene{}{}".format(suffix,half)] = genes.to_numpy()
+    CI_dict["gene_strand_AB{}{}".format(suffix,half)] = strands.to_numpy()
+    sides.append(chrs + ":" + genes + ":" + pos.astype(str) + ":" + strands)
+    if half == "A":
+      unspliced = chrs + ":" + genes + ":" + strands
+
+  # reads without a junction (genomic alignments) are named chr:gene:strand
+  read_junc_types = pd.Series(CI_dict["juncType" + suffix], index=chrs.index, dtype=object)
+  refNames = sides[0] + "|" + sides[1] + "|" + read_junc_types
+  genomic = read_junc_types.isna()
+  refNames[genomic] = unspliced[genomic]
+  CI_dict["refName_AB" + suffix] = refNames.to_numpy()
+  return CI_dict
+
 def get_SM(cigar, fill_char = np.nan):
   if not isinstance(cigar, str):
     return fill_char, fill_char, fill_char, fill_char
-  matches = re.findall(r'(\d+)([A-Z]{1})', cigar)
-  M = 0
-  S = 0
-  I = 0
-  D = 0
-  for m in matches:
-    if m[1] == "M":
-      M += int(m[0])
-    elif m[1] == "S":
-      S += int(m[0])
-    elif m[1] == "I":
-      I += int(m[0])
-    elif m[1] == "D":
-      D += int(m[0])
-
-  return M, S, I, D
+  totals = scan_cigar(cigar_tuples(cigar))[3]
+  return totals[0], totals[4], totals[1], totals[2]
 
 def entropy(kmer, c=5):
     """Calculate the entropy of a kmer using cmers as the pieces of information"""
@@ -402,37 +722,145 @@ def count_stretch(s):
   counts[s[-1]] = max(counts[s[-1]], curr_stretch)
   return counts
 
+# base codes for the vectorized sequence features; 0 is padding past the end of a read
+seq_bases = "ATGCN"
+base_codes = np.full(256, len(seq_bases) + 1, dtype=np.uint8)
+for b, base in enumerate(seq_bases):
+  base_codes[ord(base)] = b + 1
+
+def encode_seqs(seqs, pad = 0):
+  """Sequences as a 2-D uint8 array of base codes (zero padded on the right) and their lengths"""
+  lengths = np.fromiter((len(seq) for seq in seqs), dtype=np.int64, count=len(seqs))
+  width = max(int(lengths.max(initial=0)), pad)
+  codes = np.zeros((len(seqs), width), dtype=np.uint8)
+  codes[np.arange(width) < lengths[:, None]] = base_codes[np.frombuffer("".join(seqs).encode("ascii"), dtype=np.uint8)]
+  return codes, lengths
+
+def run_features(codes):
+  """Longest run of every base in seq_bases per row, like count_stretch"""
+  pos = np.arange(codes.shape[1])
+  starts = np.ones(codes.shape, dtype=bool)
+  starts[:, 1:] = codes[:, 1:] != codes[:, :-1]
+  run_len = pos - np.maximum.accumulate(np.where(starts, pos, 0), axis=1) + 1
+  return {base : np.where(codes == b + 1, run_len, 0).max(axis=1, initial=0) for b, base in enumerate(seq_bases)}
+
+def window_max_features(codes, k = 10):
+  """Most copies of each base in any k-mer per row, like max_base
+
+  Windows running past the end of a read count a subset of the last full window, so they never
+  raise the maximum; a read shorter than k gets the counts of the whole read.
+  """
+  maxes = {}
+  for b, base in enumerate(seq_bases[:4]):
+    cumsum = np.zeros((codes.shape[0], codes.shape[1] + 1), dtype=np.int64)
+    np.cumsum(codes == b + 1, axis=1, out=cumsum[:, 1:])
+    maxes[base] = (cumsum[:, k:] - cumsum[:, :-k]).max(axis=1, initial=0)
+  return maxes
+
+def entropy_features(codes, lengths, c = 5):
+  """entropy(seq, c) of every row, from the sorted c-mer codes of each row"""
+  n = codes.shape[0]
+  num_cmers = lengths - c + 1
+  width = codes.shape[1] - c + 1
+  if width <= 0:
+    return np.zeros(n)
+  cmers = np.zeros((n, width), dtype=np.int64)
+  for j in range(c):
+    cmers = cmers * (len(seq_bases) + 2) + codes[:, j:j + width]
+  valid = np.arange(width) < num_cmers[:, None]
+  cmers[~valid] = np.iinfo(np.int64).max
+  cmers.sort(axis=1)
+
+  # sum of count * log(count) over distinct c-mers, accumulated as each copy's rank k in its run
+  # adds k log k - (k - 1) log(k - 1)
+  pos = np.arange(width)
+  starts = np.ones(cmers.shape, dtype=bool)
+  starts[:, 1:] = cmers[:, 1:] != cmers[:, :-1]
+  rank = pos - np.maximum.accumulate(np.where(starts, pos, 0), axis=1) + 1
+  klogk = np.zeros(width + 1)
+  klogk[1:] = np.arange(1, width + 1) * np.log(np.arange(1, width + 1))
+  sum_clogc = np.where(valid, klogk[rank] - klogk[rank - 1], 0).sum(axis=1)
+
+  ent = np.zeros(n)
+  has = num_cmers > 0
+  ent[has] = np.log(num_cmers[has]) - sum_clogc[has] / num_cmers[has]
+  return ent
+
+def add_seq_features(CI_dict, suffix, chunk_size = 10000):
+  """Fill in the run, entropy and 10-mer base count columns of a chunk of reads from their sequences"""
+  seqs = CI_dict["seq" + suffix]
+  if len(seqs) == 0:
+    return CI_dict
+  features = defaultdict(list)
+  for start in range(0, len(seqs), chunk_size):
+    codes, lengths = encode_seqs(seqs[start:start + chunk_size], pad=10)
+    runs = run_features(codes)
+    features["AT_run_"].append(np.maximum(runs["A"], runs["T"]))
+    features["GC_run_"].append(np.maximum(runs["G"], runs["C"]))
+    features["max_run_"].append(np.max([runs[base] for base in seq_bases], axis=0))
+    features["entropy"].append(entropy_features(codes, lengths))
+    for base, counts in window_max_features(codes).items():
+      features["max{}_10mer".format(base)].append(counts)
+  for name, chunks in features.items():
+    CI_dict[name + suffix] = np.concatenate(chunks)
+
+  # entropy was written with 3 decimals for aligned reads but with "%3.f" for chimeric ones
+  chimeric = np.asarray(CI_dict["fileType" + suffix], dtype=object) == "Chimeric"
+  CI_dict["entropy" + suffix] = np.where(chimeric, np.round(CI_dict["entropy" + suffix]), np.round(CI_dict["entropy" + suffix], 3))
+  return CI_dict
+
+# 2-bit codes of the bases of a barcode or UMI
+packed_bases = "ACGT"
+packed_codes = np.full(256, len(packed_bases), dtype=np.int64)
+for b, base in enumerate(packed_bases):
+  packed_codes[ord(base)] = b
+
+def pack_bases(seqs):
+  """Barcodes or UMIs as nullable Int64, 2 bits a base under a leading 1 bit that keeps the length
+
+  Only ACGT strings of 1 to 31 bases pack; anything else (a missing value, an N) is null.
+  """
+  seqs = list(seqs)
+  is_str = np.fromiter((isinstance(seq, str) for seq in seqs), dtype=bool, count=len(seqs))
+  strs = [seq for seq, ok in zip(seqs, is_str) if ok]
+  lengths = np.fromiter(map(len, strs), dtype=np.int64, count=len(strs))
+  width = int(lengths.max(initial=0))
+  in_seq = np.arange(width) < lengths[:, None]
+  codes = np.zeros((len(strs), width), dtype=np.int64)
+  codes[in_seq] = packed_codes[np.frombuffer("".join(strs).encode("ascii"), dtype=np.uint8)]
+  packed = np.ones(len(strs), dtype=np.int64)
+  for j in range(min(width, 31)):
+    packed = np.where(in_seq[:, j], (packed << 2) | codes[:, j], packed)
+  values = np.zeros(len(seqs), dtype=np.int64)
+  values[is_str] = packed
+  missing = ~is_str
+  missing[is_str] = (codes == len(packed_bases)).any(axis=1) | (lengths == 0) | (lengths > 31)
+  return pd.arrays.IntegerArray(values, missing)
+
+def unpack_bases(packed):
+  """The strings pack_bases packed, NaN where it gave a null"""
+  packed = pd.array(packed, dtype="Int64")
+  missing = np.asarray(packed.isna())
+  values = packed.to_numpy(dtype=np.int64, na_value=1)
+  lengths = (values[:, None] >= np.left_shift(1, 2 * np.arange(1, 32))).sum(axis=1)
+  width = int(lengths.max(initial=0))
+  seqs = np.full(len(values), np.nan, dtype=object)
+  if width == 0:
+    seqs[~missing] = ""
+    return seqs
+  shifts = 2 * (lengths[:, None] - 1 - np.arange(width))
+  chars = np.frombuffer(packed_bases.encode("ascii"), dtype=np.uint8)[(values[:, None] >> np.maximum(shifts, 0)) & 3]
+  chars[shifts < 0] = 0
+  seqs[~missing] = np.ascontiguousarray(chars).view("S{}".format(width)).ravel().astype(str)[~missing]
+  return seqs
+
 def nmm(MD):
   return len(''.join(filter(["A","C","G","T"].__contains__, MD)))
 
 def split_cigar_align(cigar, fill_char = np.nan):
   if "N" not in cigar:
     return cigar, fill_char
-  matches = re.findall(r'(\d+)([A-Z]{1})', cigar)
-  
-  # find the largest N (the one to split on)
-  max_N_ind = None
-  max_N_val = 0
-  for i in range(len(matches)):
-      m = matches[i]
-      if m[1] == "N":
-          if int(m[0]) > max_N_val:
-              max_N_ind = i
-              max_N_val = int(m[0])
-  cigar1 = "".join(["".join(m) for m in matches[:max_N_ind]])
-  cigar2 = "".join(["".join(m) for m in matches[max_N_ind + 1:]])
-  return cigar1, cigar2
+  return align_cigar(cigar_tuples(cigar), 0, fill_char)[:2]
 
 def split_cigar_chim(cigar):
-    matches = re.findall(r'(\d+)([A-Z]{1})', cigar)
-    if (matches[0][1] == "S") and (matches[-1][1] != "S"):
-      cigar1 = "".join(["".join(m) for m in matches[1:]])
-    elif (matches[-1][1] == "S") and (matches[0][1] != "S"):
-      cigar1 = "".join(["".join(m) for m in matches[:-1]])
-    else:
-      assert (matches[0][1] == "S") and (matches[-1][1] == "S")
-      if int(matches[0][0]) > int(matches[-1][0]):
-        cigar1 = "".join(["".join(m) for m in matches[1:]])
-      else:
-        cigar1 = "".join(["".join(m) for m in matches[:-1]])
-    return cigar1
+  return chim_cigar(cigar_tuples(cigar))[0]
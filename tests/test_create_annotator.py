@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import create_annotator
+
+def gtf(attributes):
+  return pd.DataFrame({"seqname" : "chr1", "feature" : "exon", "start" : [100, 300, 500, 700], "end" : [200, 400, 600, 800], "attribute" : attributes})
+
+def test_splices_of_consecutive_exons():
+  splices = create_annotator.get_splices(gtf(['gene_id "G1"; transcript_id "T1"; exon_number "1"; gene_name "A";',
+                                              'gene_id "G1"; transcript_id "T1"; exon_number "2"; gene_name "A";',
+                                              'gene_id "G1"; transcript_id "T1"; exon_number "3"; gene_name "A";',
+                                              'gene_id "G2"; transcript_id "T2"; exon_number "1"; gene_name "B";']))
+  assert splices == {"chr1" : {(200, 300), (400, 500)}}
+
+def test_exon_without_transcript_id_or_exon_number_is_dropped():
+  splices = create_annotator.get_splices(gtf(['gene_id "G1"; transcript_id "T1"; exon_number "1"; gene_name "A";',
+                                              'gene_id "G1"; transcript_id "T1"; exon_number "2"; gene_name "A";',
+                                              'gene_id "G1"; gene_name "A";',
+                                              'gene_id "G1"; transcript_id "T1"; gene_name "A";']))
+  assert splices == {"chr1" : {(200, 300)}}
+
+def test_gff_attributes():
+  splices = create_annotator.get_splices(gtf(["ID=exon-T1-1;Parent=T1;gene=A",
+                                              "ID=exon-T1-2;Parent=T1;gene=A",
+                                              "ID=exon-T2;Parent=T2;gene=B",
+                                              "ID=exon-T1-3;transcript_id=T1;exon_number=3;gene=A"]))
+  assert splices == {"chr1" : {(200, 300), (400, 700)}}
@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pandas as pd
+import pysam
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import light_class_input
+
+header = {"HD" : {"VN" : "1.4"}, "SQ" : [{"SN" : "chr1", "LN" : 100000}, {"SN" : "chr2", "LN" : 100000}]}
+seq = "ACGTTGCAAC" * 10
+
+# chimeric reads as STAR writes them in an unsorted bam: both halves in the order they cover the read as sequenced
+chimeras = {
+  # halves on different contigs, the first one on the later contig
+  "cross_contig" : [(0, 1, 5000, "40M60S"), (0, 0, 9000, "40S60M")],
+  # halves on opposite strands, the second one further up the contig
+  "strand_inconsistent" : [(0, 0, 8000, "40M60S"), (16, 0, 2000, "60M40S")],
+  "both_reverse" : [(16, 0, 7000, "70S30M"), (16, 0, 3000, "70M30S")],
+  # the supplementary half covers the start of the read
+  "supplementary_first" : [(2048, 0, 6000, "30M70S"), (0, 1, 1000, "30S70M")],
+  # halves starting at the same offset, representative first
+  "same_offset" : [(0, 0, 9500, "50M50S"), (2048, 0, 4000, "50M50S")],
+}
+
+def record(bam, name, flag, tid, pos, cigar, tags):
+  read = pysam.AlignedSegment(bam.header)
+  read.query_name = name
+  read.flag = flag
+  read.reference_id = tid
+  read.reference_start = pos
+  read.mapping_quality = 255
+  read.cigarstring = cigar
+  read.query_sequence = seq[:read.query_length]
+  read.set_tags(tags)
+  return read
+
+def write_bam(path):
+  with pysam.AlignmentFile(path, "wb", header=header) as bam:
+    for name, halves in chimeras.items():
+      for score, (flag, tid, pos, cigar) in zip([90, 60], halves):
+        bam.write(record(bam, name, flag, tid, pos, cigar, [("NH", 1), ("HI", 1), ("AS", score), ("nM", 0), ("MD", "100"), ("ch", 1)]))
+    bam.write(record(bam, "spliced", 0, 0, 500, "50M1000N50M", [("NH", 1), ("HI", 1), ("AS", 98), ("nM", 0), ("MD", "100")]))
+
+def frame(CI):
+  # the columns parsed from the bam, not the ones build_CI_df fills in later
+  return pd.DataFrame({c : v for c, v in CI.to_dict().items() if len(v) == len(CI)}).sort_values("id").reset_index(drop=True)
+
+def test_contig_mode_pairs_chimeric_halves_like_parse_bam(tmp_path):
+  bam_file = str(tmp_path / "unsorted.bam")
+  sorted_file = str(tmp_path / "sorted.bam")
+  write_bam(bam_file)
+  pysam.sort("-o", sorted_file, bam_file)
+  pysam.index(sorted_file)
+  assert light_class_input.parallel_mode(sorted_file) == "contig"
+
+  serial = frame(next(light_class_input.parse_bam(bam_file, "R1", False))[0])
+  parallel = frame(light_class_input.parse_bam_parallel(sorted_file, "R1", False, 2)[0])
+  assert len(serial) == len(chimeras) + 1
+  pd.testing.assert_frame_equal(serial, parallel[serial.columns])
@@ -0,0 +1,39 @@
+import os
+import sys
+import types
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import annotator
+import light_utils
+
+ann = types.SimpleNamespace(gene_strands=annotator.GeneStrands.from_table(pd.DataFrame({"gene_name" : ["G1","G2","G3"], "strand" : ["+","+","-"]})))
+
+def read(refname, geneA, posA, geneB, posB):
+  return {"id" : "r" + str(posA), "fileTypeR1" : "Aligned", "refName_ABR1" : refname, "geneR1A" : geneA, "geneR1B" : geneB,
+          "chrR1A" : "chr1", "chrR1B" : "chr1", "juncPosR1A" : posA, "juncPosR1B" : posB, "read_strandR1A" : "+", "read_strandR1B" : np.nan,
+          "HIR1A" : 1, "juncTypeR1" : "lin", "gene_strand_ABR1A" : "+", "gene_strand_ABR1B" : "+"}
+
+def test_reads_without_refname_get_no_junction():
+  CI = pd.DataFrame([read(np.nan, "G1", 50, "G1", 60),
+                     read("chr1:G1:100:+|chr1:G1:200:+|lin", "G1", 100, "G1", 200),
+                     read(np.nan, "G3", 70, "G3", 80),
+                     read("chr1:G2:300:+|chr1:G2:400:+|lin", "G2", 300, "G2", 400),
+                     read("chr1:G1:100:+|chr1:G1:200:+|lin", "G1", 100, "G1", 200)])
+  renamed = light_utils.modify_refnames(CI, "hg38", ann=ann)
+  assert renamed["refName_newR1"].isna().tolist() == [True, False, True, False, False]
+  assert renamed["refName_newR1"][1] == renamed["refName_newR1"][4] == "chr1:G1:100:+|chr1:G1:200:+|lin"
+  assert renamed["refName_newR1"][3] == "chr1:G2:300:+|chr1:G2:400:+|lin"
+  assert renamed["junction_id"].isna().tolist() == [True, False, True, False, False]
+  assert renamed["junction_id"][1] == light_utils.junction_ids(["chr1:G1:100:+|chr1:G1:200:+|lin"])[0]
+
+def test_known_junctions_carry_over_chunks():
+  known = light_utils.JunctionNames()
+  first = light_utils.modify_refnames(pd.DataFrame([read("chr1:G1:100:+|chr1:G1:200:+|lin", "G1", 100, "G1", 200)]), "hg38", known, ann)
+  second = light_utils.modify_refnames(pd.DataFrame([read(np.nan, "G2", 10, "G2", 20),
+                                                     read("chr1:G1:100:+|chr1:G1:200:+|lin", "G1", 100, "G1", 200)]), "hg38", known, ann)
+  assert second["refName_newR1"].isna().tolist() == [True, False]
+  assert second["refName_newR1"][1] == first["refName_newR1"][0]
+  assert second["junc_typeR1"][1] == first["junc_typeR1"][0]